@@ -0,0 +1,217 @@
+#Batch Preprocessing: run several region configs in a single process
+import argparse
+import copy
+import importlib.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Preprocessing import load_config, run_preprocessing
+
+from gmi_gds_data_read_write.reader import gcs_reader, bq_reader
+from gmi_gds_data_read_write.writer import gcs_writer
+from gmi_gds_logging import console_logger, file_logger
+
+
+class MemoryBudget:
+    """Blocks region runs until their estimated memory fits inside a global budget."""
+
+    def __init__(self, total_gb):
+        self.total_gb = total_gb
+        self.used_gb = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount_gb):
+        # A single region larger than the whole budget still runs, but alone
+        amount_gb = min(amount_gb, self.total_gb)
+        with self._condition:
+            while self.used_gb + amount_gb > self.total_gb:
+                self._condition.wait()
+            self.used_gb += amount_gb
+        return amount_gb
+
+    def release(self, amount_gb):
+        with self._condition:
+            self.used_gb -= amount_gb
+            self._condition.notify_all()
+
+
+class SharedClients:
+    """Creates GCS/BQ clients once per project and hands the same objects to every region."""
+
+    def __init__(self, logger):
+        self.logger = logger
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, project_id, factory):
+        with self._lock:
+            key = (kind, project_id)
+            if key not in self._clients:
+                self._clients[key] = factory(project_id=project_id, logger=self.logger)
+            return self._clients[key]
+
+    def gcs_reader(self, project_id):
+        return self._get("gcs_reader", project_id, gcs_reader.GCSReader)
+
+    def gcs_writer(self, project_id):
+        return self._get("gcs_writer", project_id, gcs_writer.GCSWriter)
+
+    def bq_reader(self, project_id):
+        return self._get("bq_reader", project_id, lambda project_id, logger: bq_reader.BQReader(project_id, logger))
+
+
+def _substitute_region(value, region):
+    """Replace the '{region}' placeholder in every string of a (nested) config value."""
+    if isinstance(value, str):
+        return value.replace("{region}", region)
+    if isinstance(value, list):
+        return [_substitute_region(item, region) for item in value]
+    if isinstance(value, dict):
+        return {key: _substitute_region(item, region) for key, item in value.items()}
+    return value
+
+
+def expand_region_configs(config, default_name="default"):
+    """
+    Expand one loaded config into one config per region.
+
+    A config may carry a `regions` matrix: a list of mappings with a `name` and any
+    keys that override the base config for that region. The placeholder `{region}`
+    in any string value is replaced by the region name. A config without `regions`
+    is returned as a single region named by its `region` key, or `default_name`.
+    """
+    regions = config.get("regions")
+    base = {key: value for key, value in config.items() if key not in ("regions", "batch")}
+    if not regions:
+        return [(config.get("region", default_name), base)]
+
+    region_configs = []
+    for region in regions:
+        overrides = dict(region)
+        name = overrides.pop("name")
+        merged = copy.deepcopy(base)
+        merged.update(overrides)
+        region_configs.append((name, _substitute_region(merged, name)))
+    return region_configs
+
+
+def _load_data_ingestion_module():
+    """Import data-ingestion_v2.py, whose file name is not a valid module name."""
+    module_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data-ingestion_v2.py")
+    spec = importlib.util.spec_from_file_location("data_ingestion_v2", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _run_region(name, config, clients, budget, memory_gb, logger, ingest=None):
+    """Run ingestion (optional) and preprocessing for one region under the memory budget."""
+    reserved = budget.acquire(memory_gb)
+    try:
+        logger.info(f"Starting region '{name}' (reserved {reserved} GB of memory budget)")
+        project_id = config.get("project_id")
+        if ingest is not None:
+            ingest.run_data_ingestion_config(config, logger=logger,
+                                             db_reader=clients.bq_reader(project_id),
+                                             gcs_writer_obj=clients.gcs_writer(project_id))
+        if not run_preprocessing(config, clients.gcs_reader(project_id), clients.gcs_writer(project_id), logger):
+            raise RuntimeError(f"Preprocessing terminated early for region '{name}'")
+        logger.info(f"Finished region '{name}'")
+    finally:
+        budget.release(reserved)
+
+
+def run_batch(config_files, max_workers=None, memory_budget_gb=None, default_region_memory_gb=None, ingest=False):
+    """
+    Run the preprocessing pipeline for every region found in the given config files.
+
+    Parameters:
+    -----------
+    config_files : list
+        Paths of region YAML configs. Each file may hold a single region or a `regions` matrix.
+    max_workers : int, optional
+        Number of regions processed concurrently. Defaults to the `batch.max_workers` config value or 4.
+    memory_budget_gb : float, optional
+        Global memory budget shared by concurrently running regions.
+        Defaults to the `batch.memory_budget_gb` config value or 32.
+    default_region_memory_gb : float, optional
+        Memory estimate for regions without their own `memory_estimate_gb`.
+        Defaults to the `batch.default_region_memory_gb` config value or 8.
+    ingest : bool
+        Run data ingestion for each region before preprocessing.
+
+    Returns:
+    --------
+    dict
+        Region name -> None on success or the raised exception on failure.
+    """
+    region_configs = []
+    renamed = []
+    batch_settings = {}
+    for config_file in config_files:
+        config = load_config(config_file)
+        if config is None:
+            console_logger.error(f"Configuration loading failed for {config_file}, skipping.")
+            continue
+        batch_settings = {**batch_settings, **config.get("batch", {})}
+        # Single-region files are named after the file so results do not overwrite each other
+        file_stem = os.path.splitext(os.path.basename(config_file))[0]
+        for name, region_config in expand_region_configs(config, default_name=file_stem):
+            unique_name, suffix = name, 2
+            while unique_name in (existing for existing, _ in region_configs):
+                unique_name, suffix = f"{name}-{suffix}", suffix + 1
+            if unique_name != name:
+                renamed.append(f"Region name '{name}' from {config_file} is already used, running it as '{unique_name}'.")
+            region_configs.append((unique_name, region_config))
+
+    if max_workers is None:
+        max_workers = batch_settings.get("max_workers", 4)
+    if memory_budget_gb is None:
+        memory_budget_gb = batch_settings.get("memory_budget_gb", 32)
+    if default_region_memory_gb is None:
+        default_region_memory_gb = batch_settings.get("default_region_memory_gb", 8)
+
+    # One logger, one set of clients and one worker pool shared by every region
+    console_log = console_logger.ConsoleLogger("console")
+    combined_logger = file_logger.FileLogger(name="batch_preprocessing", logger=console_log)
+    for message in renamed:
+        combined_logger.warning(message)
+    clients = SharedClients(combined_logger)
+    budget = MemoryBudget(memory_budget_gb)
+    ingest_module = _load_data_ingestion_module() if ingest else None
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_run_region, name, config, clients, budget,
+                            config.get("memory_estimate_gb", default_region_memory_gb),
+                            combined_logger, ingest_module): name
+            for name, config in region_configs
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                results[name] = None
+            except Exception as e:
+                combined_logger.error(f"Region '{name}' failed: {e}")
+                results[name] = e
+
+    failed = [name for name, error in results.items() if error is not None]
+    combined_logger.info(f"Batch completed: {len(results) - len(failed)} regions succeeded, {len(failed)} failed.")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Batch Data Preprocessing Script")
+    parser.add_argument('--config', nargs='+', required=True, help="One or more region YAML configuration files")
+    parser.add_argument('--max-workers', type=int, default=None, help="Regions processed concurrently")
+    parser.add_argument('--memory-budget-gb', type=float, default=None, help="Global memory budget in GB")
+    parser.add_argument('--ingest', action='store_true', help="Run data ingestion before preprocessing")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_batch(args.config, max_workers=args.max_workers, memory_budget_gb=args.memory_budget_gb, ingest=args.ingest)
@@ -1,4 +1,8 @@
 #same# Final Preprocessing.py
+import argparse
+import itertools
+import os
+import pandas as pd
 import yaml
 #from dtype_handler import DataTypeConverter
 #from date_gap_check import MonthGapChecker
@@ -7,6 +11,7 @@ import yaml
 #from categorical_binner import CategoricalBinner
 #from boxcox_transformation import BoxCox
 from utils import DataTypeConverter, MonthGapChecker, TimeSeriesMissingValueHandler,TimeSeriesOutlierHandler,CategoricalBinner,BoxCox
+from utils import GroupAlignedChunker, DataQualityScanner, sharded_clients, TypedReader, dtypes_match
 
 from gmi_gds_data_read_write.reader import gcs_reader
 from gmi_gds_data_read_write.writer import gcs_writer
@@ -28,6 +33,8 @@ def load_config(config_file: str) -> dict:
 def save_to_gcs(writer, data, file_paths, bucket_name, logger):
     """Save multiple files to GCS in a loop."""
     for data_df, output_path in zip(data, file_paths):
+        if output_path is None:
+            continue  # Optional output that is not configured
         if data_df is not None and not data_df.empty:
             try:
                 writer.write_data(data_df, bucket_name, output_path, is_overwrite=True)
@@ -42,23 +49,30 @@ def remove_unnamed_columns(df):
     unnamed_columns = df.columns[df.columns.str.contains('^Unnamed:')]
     return df.drop(columns=unnamed_columns, errors='ignore')
 
-def main():
-    # Load configuration from the YAML file
-    config_file = "utils/utils_config.yml"  # Path to your configuration file
-    config = load_config(config_file)
-    
-    if config is None:
-        console_logger.error("Configuration loading failed. Terminating the pipeline.")
-        return
+def output_paths(config):
+    """Output paths of the stage outputs, in the order returned by run_stages."""
+    return [config.get('dtype_output_path'), config.get('date_gap_check_output_path'), config.get('imputed_df_output_path'),
+            config.get("outlier_treated_df_output_path"), config['boxcox_transform_df_output_path'], config['lambda_df_output_path'],
+            config.get('quality_index_output_path')]
+
+def save_transformer_states(state_dir, transformers, combined_logger):
+    """Save the fitted state of each transformer as '<state_dir>/<name>_state.npz'."""
+    os.makedirs(state_dir, exist_ok=True)
+    for name, transformer in transformers.items():
+        try:
+            transformer.save_state(os.path.join(state_dir, f"{name}_state.npz"))
+        except Exception as e:
+            combined_logger.error(f"Failed to save {name} state: {e}")
 
+def run_stages(input_data, config, combined_logger, state_dir=None):
+    """Run every preprocessing stage on one DataFrame and return the stage outputs in save order.
+
+    When `state_dir` is given the fitted imputation, outlier and Box-Cox parameters are
+    saved there so forecast-time data can be transformed without refitting.
+    """
     # Access configuration variables
     project_id = config.get('project_id')
     column_types = config.get('column_types', {})
-    gcs_bucket_name = config.get('gcs_bucket_name')
-    dtype_output_path = config.get('dtype_output_path')
-    gap_check_output_path = config.get('date_gap_check_output_path')
-    imputed_df_output_path = config.get('imputed_df_output_path')
-    outlier_treated_df_output_path = config.get("outlier_treated_df_output_path")
     group_by_columns = config.get('group_by_columns', [])
     month_variable = config.get('month_variable')
     imputation_method = config.get('imputation_method', 'linear')
@@ -67,61 +81,67 @@ def main():
     outlier_columns_to_process = config.get('outlier_columns', [])
     outlier_method = config.get('outlier_method')
     outlier_threshold = config.get('outlier_threshold')
-    binned_df_output_path = config.get('binned_df_output_path')
-    boxcox_transform_df_output_path=config['boxcox_transform_df_output_path']
-    lambda_df_output_path=config['lambda_df_output_path']
     value_column=config["value_column"]
     category_column=config["category_column"]
     subcategory_column=config["subcategory_column"]
+    mmap_dir = config.get('grouped_frame_mmap_dir')  # Optional local directory for memory-mapped group arrays
 
-    # Initialize logger (Console logger and File logger)
-    console_log = console_logger.ConsoleLogger("console")
-    combined_logger = file_logger.FileLogger(name="data_preprocessing", logger=console_log)
-
-    # Initialize GCS Reader and Writer
-    gcs_reader_obj = gcs_reader.GCSReader(project_id=project_id, logger=combined_logger)
-    gcs_writer_obj = gcs_writer.GCSWriter(project_id=project_id, logger=combined_logger)
+    # A failed stage leaves its output (and the outputs depending on it) as None, which save_to_gcs skips
+    converted_df = month_gap_check = imputed_data = outlier_treated_df = boxcox_transform_df = lambda_df = None
+    quality_index = scan_outlier_handler = None
+    fitted_transformers = {}
 
-    # Read input data from GCS
-    dtype_input_path = config.get('source_input_path')
-  
+    # Step 1: Data Type Conversion (skipped when the reader already applied column_types)
     try:
-        input_data = gcs_reader_obj.read_data(dtype_input_path, gcs_bucket_name)
-    except Exception as e:
-        combined_logger.error(f"Failed to read data from GCS: {e}")
-
-    if input_data is None:
-        combined_logger.error("No input data found. Terminating the pipeline.")
-        return
-
-    # Remove all unnamed columns
-    input_data = remove_unnamed_columns(input_data)
-
-    # Step 1: Data Type Conversion
-    try:
-        converter = DataTypeConverter(project_id=project_id, logger=combined_logger)
-        converted_df = converter.convert_dataframe(input_data, column_types)
+        if dtypes_match(input_data, column_types):
+            combined_logger.info("Input already has the configured column types, skipping data type conversion.")
+            converted_df = input_data
+        else:
+            converter = DataTypeConverter(project_id=project_id, logger=combined_logger)
+            converted_df = converter.convert_dataframe(input_data, column_types)
     except Exception as e:
         combined_logger.error(f"Error during data type conversion: {e}")
         
+    # Step 1b: Data quality pre-scan, so later stages skip groups with no nulls and no outliers
+    if config.get('quality_fast_path', False):
+        try:
+            quality_scanner = DataQualityScanner(project_id=project_id, logger=combined_logger)
+            scan_outlier_handler = TimeSeriesOutlierHandler(project_id=project_id, method=outlier_method, threshold=outlier_threshold)
+            quality_index = quality_scanner.scan(converted_df, outlier_columns_to_process, group_by_columns,
+                                                 month_variable=month_variable, outlier_handler=scan_outlier_handler)
+        except Exception as e:
+            combined_logger.error(f"Error during data quality scan, processing all groups: {e}")
+
     # Step 2: Month Gap Check
     try:
         month_gap_checker = MonthGapChecker(project_id=project_id, logger=combined_logger)
-        month_gap_check = month_gap_checker.generate_results(df=converted_df, group_by_columns=group_by_columns, month_variable=month_variable)
+        month_gap_check = month_gap_checker.generate_results(df=converted_df, group_by_columns=group_by_columns, month_variable=month_variable, quality_index=quality_index)
     except Exception as e:
         combined_logger.error(f"Error during month gap check: {e}")
   
     # Step 3: Missing Value Imputation
     try:
-        missing_value_handler = TimeSeriesMissingValueHandler(project_id=project_id, logger=combined_logger, k_neighbors=k_neighbors)
-        imputed_data = missing_value_handler.impute_missing_values(converted_df, outlier_columns_to_process, group_by=group_by_columns, method=imputation_method)
+        missing_value_handler = TimeSeriesMissingValueHandler(project_id=project_id, logger=combined_logger, k_neighbors=k_neighbors, mmap_dir=mmap_dir)
+        if state_dir:
+            # Fit once and apply the fitted statistics rather than computing them again
+            fitted_transformers['imputer'] = missing_value_handler.fit(converted_df, outlier_columns_to_process, group_by=group_by_columns, method=imputation_method, month_variable=month_variable)
+            imputed_data = missing_value_handler.transform(converted_df, quality_index=quality_index)
+        else:
+            imputed_data = missing_value_handler.impute_missing_values(converted_df, outlier_columns_to_process, group_by=group_by_columns, method=imputation_method, month_variable=month_variable, quality_index=quality_index)
     except Exception as e:
         combined_logger.error(f"Error during missing value imputation: {e}")
 
     # Step 4: Outlier Handling
     try:
-        outlier_handler = TimeSeriesOutlierHandler(project_id=project_id, method=outlier_method, threshold=outlier_threshold)
-        outlier_treated_df= outlier_handler.handle_outliers(imputed_data, columns=outlier_columns_to_process, group_by=group_by_columns)
+        outlier_handler = TimeSeriesOutlierHandler(project_id=project_id, method=outlier_method, threshold=outlier_threshold, mmap_dir=mmap_dir)
+        if state_dir and outlier_method != 'rolling':
+            # With the quality fast path only flagged groups are fitted; clean groups reuse the scanned bounds,
+            # have no values outside them, and are left as they are by transform
+            fitted_transformers['outlier_handler'] = outlier_handler.fit(imputed_data, outlier_columns_to_process, group_by=group_by_columns, month_variable=month_variable,
+                                                                         quality_index=quality_index, scan_handler=scan_outlier_handler)
+            outlier_treated_df = outlier_handler.transform(imputed_data)
+        else:
+            outlier_treated_df= outlier_handler.handle_outliers(imputed_data, columns=outlier_columns_to_process, group_by=group_by_columns, month_variable=month_variable, quality_index=quality_index)
 
     except Exception as e:
         combined_logger.error(f"Error during missing value imputation: {e}")
@@ -136,17 +156,201 @@ def main():
         ''' 
     #step 6: boxcox Transformation
     try:
-        boxcox_transform = BoxCox(project_id=project_id, logger=combined_logger)
+        boxcox_transform = BoxCox(project_id=project_id, logger=combined_logger, mmap_dir=mmap_dir)
         boxcox_transform_df, lambda_df= boxcox_transform.apply_boxcox(outlier_treated_df,value_column, category_column, subcategory_column)
+        fitted_transformers['boxcox'] = boxcox_transform
     except Exception as e:
-        combined_logger.error(f"Error during missing value imputation: {e}")                     
-    
+        combined_logger.error(f"Error during missing value imputation: {e}")
+
+    if state_dir:
+        save_transformer_states(state_dir, fitted_transformers, combined_logger)
+
+    return [converted_df, month_gap_check, imputed_data, outlier_treated_df,boxcox_transform_df,lambda_df,quality_index]#,df_binned
+
+def part_path(output_path, part_number):
+    """Path of one chunk's part file, e.g. 'dir/name_part-00003.csv'."""
+    root, ext = os.path.splitext(output_path)
+    return f"{root}_part-{part_number:05d}{ext}"
+
+def typed_reader_for(config, combined_logger):
+    """TypedReader for the `typed_read` config section, or None when it is disabled."""
+    settings = config.get('typed_read', {})
+    if not settings.get('enabled', False):
+        return None
+    return TypedReader(project_id=config.get('project_id'), logger=combined_logger, engine=settings.get('engine'))
+
+def read_input(config, gcs_reader_obj, combined_logger, sharded_reader=None):
+    """
+    Read the source input. With `typed_read` enabled the column_types dtypes, the
+    required_columns selection and month parsing are applied by the parser in one pass.
+    """
+    gcs_bucket_name = config.get('gcs_bucket_name')
+    dtype_input_path = config.get('source_input_path')
+    typed_reader = typed_reader_for(config, combined_logger)
+    if typed_reader is None:
+        return gcs_reader_obj.read_data(dtype_input_path, gcs_bucket_name)
+
+    schema = dict(column_types=config.get('column_types', {}), required_columns=config.get('required_columns'),
+                  month_variable=config.get('month_variable'))
+    if sharded_reader is None:
+        return typed_reader.read(f"gs://{gcs_bucket_name}/{dtype_input_path}", **schema,
+                                 file_format=config['typed_read'].get('file_format'))
+
+    manifest = sharded_reader.read_manifest(dtype_input_path, gcs_bucket_name)
+    read_kwargs = typed_reader.read_kwargs(**schema, available_columns=manifest['columns'])
+    try:
+        return sharded_reader.read_data(dtype_input_path, gcs_bucket_name, **read_kwargs)
+    except (ValueError, TypeError) as e:
+        combined_logger.warning(f"Typed read failed ({e}); reading without dtype hints.")
+        return sharded_reader.read_data(dtype_input_path, gcs_bucket_name, usecols=read_kwargs.get('usecols'))
+
+def run_out_of_core(config, gcs_writer_obj, combined_logger, sharded_reader=None):
+    """
+    Run the pipeline on group-aligned chunks of the input so memory stays bounded.
+
+    Every stage runs per chunk and its output is written as one part file per chunk;
+    the gap-check and lambda tables are small and are accumulated, then written whole.
+    A sharded input is streamed part by part through `sharded_reader`.
+    """
+    settings = config.get('out_of_core', {})
+    gcs_bucket_name = config.get('gcs_bucket_name')
+    dtype_input_path = config.get('source_input_path')
+    group_by_columns = config.get('group_by_columns', [])
+
+    # Chunks must keep both the time-series groups and the Box-Cox groups whole
+    chunk_keys = [col for col in group_by_columns if col in (config["category_column"], config["subcategory_column"])]
+    if not chunk_keys:
+        combined_logger.error("Out-of-core mode needs group_by_columns to share a column with the Box-Cox grouping. Terminating the pipeline.")
+        return False
+
+    chunker = GroupAlignedChunker(project_id=config.get('project_id'), logger=combined_logger, group_by_columns=chunk_keys,
+                                  memory_limit_mb=settings.get('memory_limit_mb', 16384),
+                                  num_partitions=settings.get('num_partitions', 256),
+                                  spool_dir=settings.get('spool_dir'))
+    def start_stream(read_kwargs):
+        if sharded_reader is not None:
+            frames = sharded_reader.iter_parts(dtype_input_path, gcs_bucket_name, **read_kwargs)
+        else:
+            frames = pd.read_csv(f"gs://{gcs_bucket_name}/{dtype_input_path}", chunksize=settings.get('read_chunk_rows', 200000),
+                                 **read_kwargs)
+        # The readers are lazy; the chunker spools the whole input before yielding its first
+        # chunk, so taking that chunk here surfaces every read error to the caller
+        chunks = chunker.iter_chunks(frames)
+        return chunks, next(chunks, None)
+
+    try:
+        typed_reader = typed_reader_for(config, combined_logger)
+        if typed_reader is None:
+            chunks, first_chunk = start_stream({})
+        else:
+            if sharded_reader is not None:
+                available_columns = sharded_reader.read_manifest(dtype_input_path, gcs_bucket_name)['columns']
+            else:
+                available_columns = list(pd.read_csv(f"gs://{gcs_bucket_name}/{dtype_input_path}", nrows=0).columns)
+            # Chunked reads need the C engine; the pyarrow engine has no chunksize support
+            read_kwargs = typed_reader.read_kwargs(config.get('column_types', {}), config.get('required_columns'),
+                                                   config.get('month_variable'), available_columns=available_columns, engine='c')
+            try:
+                chunks, first_chunk = start_stream(read_kwargs)
+            except (ValueError, TypeError) as e:
+                # Nothing has been processed yet, so the whole stream is restarted without dtype hints
+                combined_logger.warning(f"Typed read failed ({e}); reading without dtype hints.")
+                chunks, first_chunk = start_stream({'usecols': read_kwargs.get('usecols')})
+    except Exception as e:
+        combined_logger.error(f"Failed to read data from GCS: {e}")
+        return False
+
+    file_paths = output_paths(config)
+    accumulated_tables = {1: [], 5: [], 6: []}  # month gap check, lambda and quality index tables, by stage position
+    first_chunks = [] if first_chunk is None else [first_chunk]
+    for part_number, chunk in enumerate(itertools.chain(first_chunks, chunks)):
+        chunk = remove_unnamed_columns(chunk)
+        state_dir = config.get('transformer_state_dir')
+        if state_dir:
+            # Chunks hold disjoint groups; their states are combined by passing all part paths to load_state
+            state_dir = os.path.join(state_dir, f"part-{part_number:05d}")
+        stage_outputs = run_stages(chunk, config, combined_logger, state_dir=state_dir)
+        for stage, (data_df, output_path) in enumerate(zip(stage_outputs, file_paths)):
+            if stage in accumulated_tables:
+                if data_df is not None:
+                    accumulated_tables[stage].append(data_df)
+            elif output_path is not None:  # Optional outputs that are not configured are skipped
+                save_to_gcs(gcs_writer_obj, [data_df], [part_path(output_path, part_number)], gcs_bucket_name, combined_logger)
+        combined_logger.info(f"Processed chunk {part_number} with {len(chunk)} rows.")
+        del chunk, stage_outputs
+
+    # The lambda table is indexed by group key; the other tables have a plain row index
+    tables = [pd.concat(tables_list, ignore_index=(stage != 5)) if tables_list else None
+              for stage, tables_list in accumulated_tables.items()]
+    save_to_gcs(gcs_writer_obj, tables, [file_paths[stage] for stage in accumulated_tables], gcs_bucket_name, combined_logger)
+
+    combined_logger.info("Data processing pipeline completed successfully.")
+    return True
+
+def run_preprocessing(config, gcs_reader_obj, gcs_writer_obj, combined_logger):
+    """Run every preprocessing stage for one loaded config using the given clients.
+
+    The reader, writer and logger are passed in so that several region configs
+    can share them when run from the batch runner. With `sharded_output` enabled the
+    input and outputs are read and written as compressed part files with a manifest.
+    Returns True when the pipeline ran to the end and False when it was terminated.
+    """
+    sharded_reader = None
+    sharded_settings = config.get('sharded_output', {})
+    if sharded_settings.get('enabled', False):
+        gcs_reader_obj, gcs_writer_obj = sharded_clients(config.get('project_id'), combined_logger, sharded_settings)
+        sharded_reader = gcs_reader_obj
+
+    if config.get('out_of_core', {}).get('enabled', False):
+        return run_out_of_core(config, gcs_writer_obj, combined_logger, sharded_reader=sharded_reader)
+
+    gcs_bucket_name = config.get('gcs_bucket_name')
+
+    # Read input data from GCS
+    input_data = None
+
+    try:
+        input_data = read_input(config, gcs_reader_obj, combined_logger, sharded_reader=sharded_reader)
+    except Exception as e:
+        combined_logger.error(f"Failed to read data from GCS: {e}")
+
+    if input_data is None:
+        combined_logger.error("No input data found. Terminating the pipeline.")
+        return False
+
+    # Remove all unnamed columns
+    input_data = remove_unnamed_columns(input_data)
+
+    data_to_save = run_stages(input_data, config, combined_logger, state_dir=config.get('transformer_state_dir'))
+
     # Save files to GCS in a loop
-    data_to_save = [converted_df, month_gap_check, imputed_data, outlier_treated_df,boxcox_transform_df,lambda_df]#,df_binned,binned_df_output_path
-    file_paths = [dtype_output_path, gap_check_output_path, imputed_df_output_path,outlier_treated_df_output_path,boxcox_transform_df_output_path,lambda_df_output_path] #, 
-    save_to_gcs(gcs_writer_obj, data_to_save, file_paths, gcs_bucket_name, combined_logger)
+    save_to_gcs(gcs_writer_obj, data_to_save, output_paths(config), gcs_bucket_name, combined_logger)
 
     combined_logger.info("Data processing pipeline completed successfully.")
+    return True
+
+def main(config_file="utils/utils_config.yml"):
+    # Load configuration from the YAML file
+    config = load_config(config_file)
+    
+    if config is None:
+        console_logger.error("Configuration loading failed. Terminating the pipeline.")
+        return
+
+    project_id = config.get('project_id')
+
+    # Initialize logger (Console logger and File logger)
+    console_log = console_logger.ConsoleLogger("console")
+    combined_logger = file_logger.FileLogger(name="data_preprocessing", logger=console_log)
+
+    # Initialize GCS Reader and Writer
+    gcs_reader_obj = gcs_reader.GCSReader(project_id=project_id, logger=combined_logger)
+    gcs_writer_obj = gcs_writer.GCSWriter(project_id=project_id, logger=combined_logger)
+
+    run_preprocessing(config, gcs_reader_obj, gcs_writer_obj, combined_logger)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Data Preprocessing Script")
+    parser.add_argument('--config', default="utils/utils_config.yml", help="Path to the YAML configuration file")
+    args = parser.parse_args()
+    main(args.config)
\ No newline at end of file
@@ -13,15 +13,20 @@ try:
 except ModuleNotFoundError as e:
     print("Environment not set up correctly, internal libraries not found in kernel")
     raise e
+
+from utils import sharded_clients
     
 class DataIngestion:
-    def __init__(self, project_id, required_columns, queries):
+    def __init__(self, project_id, required_columns, queries, logger=None, db_reader=None):
         self.project_id = project_id
         self.required_columns = required_columns
         self.queries = queries
-        self.console_log = console_logger.ConsoleLogger("console")
-        self.combined_logger = file_logger.FileLogger(name="Data_Ingestion", logger=self.console_log)
-        self.db_reader = bq_reader.BQReader(self.project_id, self.combined_logger)
+        if logger is None:
+            self.console_log = console_logger.ConsoleLogger("console")
+            logger = file_logger.FileLogger(name="Data_Ingestion", logger=self.console_log)
+        self.combined_logger = logger
+        # A reader can be shared across regions when ingestion is run in batch
+        self.db_reader = db_reader if db_reader is not None else bq_reader.BQReader(self.project_id, self.combined_logger)
 
     def _extract_file_name(self, sql_query):
         """Extracts a simplified file name from an SQL query."""
@@ -109,7 +114,16 @@ def run_data_ingestion(config_file):
     """Runs the data ingestion process."""
     # Load config from the YAML file passed as argument
     config = load_config(config_file)
+    run_data_ingestion_config(config)
+
+def run_data_ingestion_config(config, logger=None, db_reader=None, gcs_writer_obj=None):
+    """
+    Runs the data ingestion process for an already loaded configuration.
     
+    Args:
+    - config: Dictionary containing the loaded configuration.
+    - logger, db_reader, gcs_writer_obj: Optional shared clients; created when not given.
+    """
     # Access configuration values from the YAML file
     project_id = config['project_id']
     required_columns = config['required_columns']
@@ -118,12 +132,18 @@ def run_data_ingestion(config_file):
     gcs_path = config['source_input_path']  # Path in GCS where the data will be saved
 
     # Initialize and run the data ingestion
-    data_ingestion = DataIngestion(project_id=project_id, required_columns=required_columns, queries=queries)
+    data_ingestion = DataIngestion(project_id=project_id, required_columns=required_columns, queries=queries,
+                                   logger=logger, db_reader=db_reader)
     input_data = data_ingestion.ingest_data()
     
     # Save the resulting DataFrame to GCS using GCSWriter
     if input_data is not None:
-        gcs_writer_obj = gcs_writer.GCSWriter(project_id, data_ingestion.combined_logger)
+        sharded_settings = config.get('sharded_output', {})
+        if sharded_settings.get('enabled', False):
+            # Compressed part files plus a manifest, read back by Preprocessing with the same settings
+            _, gcs_writer_obj = sharded_clients(project_id, data_ingestion.combined_logger, sharded_settings)
+        elif gcs_writer_obj is None:
+            gcs_writer_obj = gcs_writer.GCSWriter(project_id, data_ingestion.combined_logger)
         gcs_writer_obj.write_data(input_data, gcs_bucket, gcs_path, is_overwrite=True)
         print(f"Data written to GCS: gs://{gcs_bucket}/{gcs_path}")
     else:
@@ -4,6 +4,11 @@ from .missingvalueimputer import TimeSeriesMissingValueHandler
 from .categorical_binner import CategoricalBinner
 from .boxcox_transformation import BoxCox
 from .time_series_outlier_handler import TimeSeriesOutlierHandler
+from .grouped_frame import GroupedFrame
+from .group_chunker import GroupAlignedChunker
+from .data_quality import DataQualityScanner
+from .sharded_io import ShardedWriter, ShardedReader, LocalFileStore, GCSStore, sharded_clients
+from .typed_reader import TypedReader, dtypes_match
 
 __all__ = [
     "DataTypeConverter",
@@ -12,4 +17,14 @@ __all__ = [
     "TimeSeriesOutlierHandler",
     "CategoricalBinner",
     "BoxCox",
+    "GroupedFrame",
+    "GroupAlignedChunker",
+    "DataQualityScanner",
+    "ShardedWriter",
+    "ShardedReader",
+    "LocalFileStore",
+    "GCSStore",
+    "sharded_clients",
+    "TypedReader",
+    "dtypes_match",
 ]
\ No newline at end of file
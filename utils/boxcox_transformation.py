@@ -1,41 +1,106 @@
 #BoxCox Transforamtion and saving Lamda Value
 import pandas as pd
 import numpy as np
-from scipy.stats import boxcox
-from scipy.special import inv_boxcox
+from scipy.stats import boxcox, boxcox_normmax
+from scipy.special import boxcox as special_boxcox, inv_boxcox
+
+from .grouped_frame import GroupedFrame
+from . import transformer_state
 
 
 class BoxCox:
-    def __init__(self, project_id: str, logger):
+    def __init__(self, project_id: str, logger, mmap_dir=None):
         self.project_id = project_id
         self.logger = logger  # Logger instance for logging operations
+        self.mmap_dir = mmap_dir  # Optional directory for memory-mapped group arrays
         
     #def apply_boxcox(self, df: pd.DataFrame, value_column: str , category_column: str  , subcategory_column: str ) -> tuple(pd.Series, pd.Series):   
     def apply_boxcox(self, df, value_column, category_column, subcategory_column):
         lambda_values = {}  # Dictionary to store lambda values for each group
 
-        for _, group in df.groupby([category_column, subcategory_column]):
-            values = group[value_column].values
+        grouped = GroupedFrame(df, [value_column], group_by=[category_column, subcategory_column], mmap_dir=self.mmap_dir)
+        try:
+            for i, start, stop in grouped.iter_groups():
+                values = grouped.column_slice(value_column, i)
+                group_key = grouped.group_key(i)
 
-            # Check if values are constant
-            if np.all(values == values[0]):
-                self.logger.warning(f"Skipping Box-Cox transformation for constant data in group {group}")
-                transformed_values = values  # Keep values as they are
-                lam = None  # No lambda for constant data
-            else:
-                # Apply Box-Cox transformation if values are non-constant
-                transformed_values, lam = boxcox(values)
+                # Check if values are constant
+                if np.all(values == values[0]):
+                    self.logger.warning(f"Skipping Box-Cox transformation for constant data in group {group_key}")
+                    lam = None  # No lambda for constant data; values are kept as they are
+                else:
+                    # Apply Box-Cox transformation if values are non-constant, in place on the group slice
+                    transformed_values, lam = boxcox(values)
+                    values[:] = transformed_values
+
+                # Record lambda value used for transformation
+                lambda_values[group_key] = lam
 
             # Store the transformed values back in the DataFrame
-            df.loc[group.index, value_column] = transformed_values
+            grouped.write_back(df)
+        finally:
+            grouped.close()
 
-            # Record lambda value used for transformation
-            lambda_values[(group[category_column].iloc[0], group[subcategory_column].iloc[0])] = lam
+        # Keep the fitted lambdas so they can be saved and reused without refitting
+        self.group_keys_ = grouped.keys
+        self.lambdas_ = np.array([np.nan if lam is None else lam for lam in lambda_values.values()], dtype=np.float64)
 
         # Return the transformed DataFrame and lambda values as a new DataFrame
         lambda_df = pd.DataFrame.from_dict(lambda_values, orient='index', columns=['Lambda'])
         return df, lambda_df
 
+    def fit(self, df, value_column, category_column, subcategory_column):
+        """Estimate the Box-Cox lambda of every (category, subcategory) group without transforming."""
+        grouped = GroupedFrame(df, [value_column], group_by=[category_column, subcategory_column], mmap_dir=self.mmap_dir)
+        try:
+            lambdas = np.full(grouped.n_groups, np.nan)
+            for i, start, stop in grouped.iter_groups():
+                values = grouped.column_slice(value_column, i)
+                # Constant groups keep a missing lambda and are left untransformed
+                if not np.all(values == values[0]):
+                    lambdas[i] = boxcox_normmax(values, method='mle')
+        finally:
+            grouped.close()
+        self.group_keys_ = grouped.keys
+        self.lambdas_ = lambdas
+        return self
+
+    def _row_lambdas(self, df):
+        positions = transformer_state.lookup_groups(df, self.group_keys_)
+        if (positions < 0).any():
+            self.logger.warning(f"{int((positions < 0).sum())} rows belong to groups without a fitted lambda and are left unchanged.")
+        return transformer_state.gather(self.lambdas_, positions)
+
+    def transform(self, df, value_column):
+        """Apply the fitted lambdas by group lookup; groups without a lambda are left unchanged."""
+        df = df.copy()
+        lambdas = self._row_lambdas(df)
+        known = ~np.isnan(lambdas)
+        values = df[value_column].to_numpy(dtype=np.float64, copy=True)
+        values[known] = special_boxcox(values[known], lambdas[known])
+        df[value_column] = values
+        return df
+
+    def inverse_transform(self, df, transformed_column):
+        """Invert the transformation with the fitted lambdas by group lookup."""
+        df = df.copy()
+        lambdas = self._row_lambdas(df)
+        known = ~np.isnan(lambdas)
+        values = df[transformed_column].to_numpy(dtype=np.float64, copy=True)
+        values[known] = inv_boxcox(values[known], lambdas[known])
+        df[transformed_column] = values
+        return df
+
+    def save_state(self, path):
+        """Save the fitted lambdas to a compact binary artifact."""
+        transformer_state.save_state(path, {'transformer': 'BoxCox'}, self.group_keys_, lambdas=self.lambdas_)
+
+    def load_state(self, paths):
+        """Load fitted lambdas from one or more artifacts written by save_state."""
+        metadata, self.group_keys_, arrays = transformer_state.load_state(paths)
+        self.lambdas_ = arrays['lambdas']
+        return self
+
     
          
     def inverse_boxcox(self, df: pd.DataFrame, transformed_column: str , category_column: str  , subcategory_column: str , lambda_df: pd.DataFrame) -> pd.Series:   
@@ -1,5 +1,7 @@
 import pandas as pd
 
+from . import transformer_state
+
 class CategoricalBinner:
     def __init__(self, project_id, logger, column_names, default_bins, rules):
         self.project_id = project_id
@@ -43,3 +45,15 @@ class CategoricalBinner:
             self.logger.info(f"Binned column '{column_name}' with rules: {column_rules}")
 
         return df
+
+    def save_state(self, path):
+        """Save the bin maps to a compact binary artifact alongside the other fitted transformers."""
+        metadata = {'transformer': 'CategoricalBinner', 'column_names': self.column_names,
+                    'default_bins': self.default_bins, 'rules': self.rules}
+        transformer_state.save_state(path, metadata, pd.DataFrame())
+
+    def load_state(self, paths):
+        """Load bin maps written by save_state."""
+        metadata, _, _ = transformer_state.load_state(paths)
+        self.column_names, self.default_bins, self.rules = metadata['column_names'], metadata['default_bins'], metadata['rules']
+        return self
@@ -0,0 +1,102 @@
+#Data quality pre-scan: group-level quality index used to skip clean groups
+import numpy as np
+import pandas as pd
+
+from .grouped_frame import GroupedFrame
+from .segment_kernels import broadcast, segment_count, segment_max, segment_min, segment_sum
+from . import transformer_state
+
+
+class DataQualityScanner:
+    def __init__(self, project_id: str, logger=None):
+        self.project_id = project_id
+        self.logger = logger  # Logger instance for logging operations
+
+    def scan(self, df, columns, group_by, month_variable=None, outlier_handler=None, outlier_method=None):
+        """
+        Build a group-level quality index in one vectorized pass.
+
+        Parameters:
+        -----------
+        df : pandas.DataFrame
+            The DataFrame containing the time series data.
+        columns : list
+            Numeric columns to profile.
+        group_by : list
+            Columns identifying a time series.
+        month_variable : str, optional
+            Month column used for the month completeness columns.
+        outlier_handler : TimeSeriesOutlierHandler, optional
+            When given, outliers are counted with its per-group bounds so the outlier stage
+            can skip groups without any. Without it every group is assumed to need treatment.
+            The handler is left fitted to the scanned data, so a later fit can reuse the
+            statistics of clean groups (see TimeSeriesOutlierHandler.fit).
+        outlier_method : str, optional
+            Detection method; defaults to the handler's own method.
+
+        Returns:
+        --------
+        pandas.DataFrame
+            One row per group: the group columns, `n_rows`, `<col>_null_count`, `<col>_min`,
+            `<col>_max`, month columns (`first_month`, `last_month`, `month_count`, `month_span`,
+            `months_complete`), `outlier_count`, and the flags `has_nulls`, `needs_imputation`,
+            `needs_outlier_treatment` and `is_clean`.
+        """
+        grouped = GroupedFrame(df, columns, group_by=group_by, month_variable=month_variable)
+        values, offsets = grouped.values, grouped.offsets
+
+        quality_index = grouped.keys.copy()
+        quality_index['n_rows'] = np.diff(offsets)
+        null_counts = quality_index['n_rows'].to_numpy() - segment_count(values, offsets)
+        minimums, maximums = segment_min(values, offsets), segment_max(values, offsets)
+        for j, col in enumerate(columns):
+            quality_index[f"{col}_null_count"] = null_counts[j]
+            quality_index[f"{col}_min"] = minimums[j]
+            quality_index[f"{col}_max"] = maximums[j]
+
+        if month_variable is not None:
+            month_values = pd.to_datetime(grouped.sorted_column(df, month_variable)).to_numpy()
+            months = month_values.astype('datetime64[M]')
+            # Rows are month-sorted within each group, so a new distinct month starts wherever the month changes
+            new_month = np.ones(len(months), dtype=bool)
+            new_month[1:] = months[1:] != months[:-1]
+            new_month[offsets[:-1][np.diff(offsets) > 0]] = True
+            new_month &= ~np.isnat(months)
+            quality_index['first_month'] = segment_min(month_values[np.newaxis], offsets)[0]
+            quality_index['last_month'] = segment_max(month_values[np.newaxis], offsets)[0]
+            first_month = segment_min(months[np.newaxis], offsets)[0]
+            last_month = segment_max(months[np.newaxis], offsets)[0]
+            quality_index['month_count'] = segment_sum(new_month[np.newaxis].astype(np.float64), offsets)[0].astype(np.int64)
+            month_span = (last_month - first_month).astype(np.int64) + 1
+            quality_index['month_span'] = np.where(np.isnat(first_month), 0, month_span)
+            quality_index['months_complete'] = quality_index['month_count'] == quality_index['month_span']
+
+        method = outlier_method or (outlier_handler.method if outlier_handler is not None else None)
+        if outlier_handler is not None and method != 'rolling':
+            lower, upper, replacement = outlier_handler.group_statistics(values, offsets, method)
+            outlier_handler._store_statistics(method, columns, grouped.keys, lower, upper, replacement)
+            outliers = (values < broadcast(lower, offsets)) | (values > broadcast(upper, offsets))
+            quality_index['outlier_count'] = segment_sum(outliers.astype(np.float64), offsets).sum(axis=0).astype(np.int64)
+            has_outliers = quality_index['outlier_count'] > 0
+        else:
+            # Rolling detection depends on neighbouring rows, so it is not pre-screened
+            has_outliers = pd.Series(True, index=quality_index.index)
+        grouped.close()
+
+        quality_index['has_nulls'] = null_counts.sum(axis=0) > 0
+        quality_index['needs_imputation'] = quality_index['has_nulls']
+        # Imputation changes a group's statistics, so groups with nulls are always re-checked for outliers
+        quality_index['needs_outlier_treatment'] = quality_index['has_nulls'] | has_outliers
+        quality_index['is_clean'] = ~(quality_index['needs_imputation'] | quality_index['needs_outlier_treatment'])
+
+        if self.logger is not None:
+            self.logger.info(f"Quality scan: {int(quality_index['is_clean'].sum())} of {len(quality_index)} groups are clean.")
+        return quality_index
+
+
+def rows_needing(df, quality_index, flag, group_by):
+    """Boolean row mask of `df` selecting the groups whose `flag` column is set in the quality index."""
+    dirty_keys = quality_index.loc[quality_index[flag], list(group_by or [])]
+    if not group_by:
+        return np.full(len(df), bool(quality_index[flag].any()))
+    return transformer_state.lookup_groups(df, dirty_keys.reset_index(drop=True)) >= 0
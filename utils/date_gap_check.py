@@ -1,7 +1,11 @@
+import numpy as np
 import pandas as pd
 from datetime import date
 from dateutil.relativedelta import relativedelta
 
+from .grouped_frame import GroupedFrame
+from .segment_kernels import segment_min, segment_max
+
 class MonthGapChecker:
     def __init__(self, project_id: str, logger=None):
         self.project_id = project_id
@@ -51,24 +55,50 @@ class MonthGapChecker:
         else:
             return "; ".join(warnings)
 
-    def generate_results(self, df, group_by_columns, month_variable='months'):
-        """Main Function to Generate Warnings and Pass/Fail Status"""
+    def _months_between(self, first_month, last_month):
+        """Vectorized form of calculate_month_gap for datetime Series."""
+        gap = (last_month.dt.year - first_month.dt.year) * 12 + last_month.dt.month - first_month.dt.month + 1
+        # Groups without any valid month keep a missing gap
+        return gap if gap.isna().any() else gap.astype('int64')
+
+    def generate_results(self, df, group_by_columns, month_variable='months', quality_index=None):
+        """Main Function to Generate Warnings and Pass/Fail Status
+
+        A quality index from DataQualityScanner already holds every group's first and
+        last month; when given, those are reused instead of grouping the data again.
+        """
         df = self.convert_to_datetime(df, month_variable)
-        df_grouped = self.group_by_combination(df, group_by_columns, month_variable)
+
+        if quality_index is not None and 'first_month' in quality_index:
+            df_grouped = quality_index[list(group_by_columns) + ['first_month', 'last_month']].copy()
+        else:
+            # First and last month of every group through the shared segment kernels
+            grouped = GroupedFrame(df, [], group_by=group_by_columns)
+            months = grouped.sorted_column(df, month_variable)[np.newaxis]
+            df_grouped = grouped.keys.copy()
+            df_grouped['first_month'] = segment_min(months, grouped.offsets)[0]
+            df_grouped['last_month'] = segment_max(months, grouped.offsets)[0]
         
         # Calculate the month gaps
-        df_grouped['month_gap'] = df_grouped.apply(self.calculate_month_gap, axis=1)
+        df_grouped['month_gap'] = self._months_between(df_grouped['first_month'], df_grouped['last_month'])
         actual_last_month = self.calculate_actual_last_month()
-        df_grouped['actual_month_gap'] = df_grouped.apply(self.calculate_actual_month_gap, actual_last_month=actual_last_month, axis=1)
+        actual_last = pd.Series(actual_last_month, index=df_grouped.index)
+        df_grouped['actual_month_gap'] = self._months_between(df_grouped['first_month'], actual_last)
         
         # Calculate the delta month gap
-        df_grouped['delta_month_gap'] = df_grouped.apply(self.calculate_delta_month_gap, axis=1)
+        df_grouped['delta_month_gap'] = df_grouped['actual_month_gap'] - df_grouped['month_gap']
         
         # Calculate expected month gap for pass/fail criteria
-        expected_month_gap = df_grouped.apply(lambda row: self.calculate_month_gap({'first_month': row['first_month'], 'last_month': actual_last_month}), axis=1)
+        expected_month_gap = self._months_between(df_grouped['first_month'], actual_last)
         
         # Generate warnings and pass/fail status
-        df_grouped['Status'] = df_grouped.apply(self.check_warnings, expected_month_gap=expected_month_gap, axis=1)
-        df_grouped['Pass/Fail'] = df_grouped['Status'].apply(lambda x: 'Fail' if 'missing' in x else 'Pass')
+        in_between_missing = df_grouped['month_gap'] < expected_month_gap
+        tail_end_missing = df_grouped['actual_month_gap'] > df_grouped['month_gap']
+        df_grouped['Status'] = np.select(
+            [in_between_missing & tail_end_missing, in_between_missing, tail_end_missing],
+            ["In-between months are missing; Tail-end data is missing", "In-between months are missing", "Tail-end data is missing"],
+            default="Pass",
+        )
+        df_grouped['Pass/Fail'] = np.where(df_grouped['Status'].str.contains('missing'), 'Fail', 'Pass')
         
         return df_grouped
@@ -0,0 +1,94 @@
+#Group-aligned chunking: re-partition a stream of DataFrames so no group spans two chunks
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pandas.api import types
+
+
+class GroupAlignedChunker:
+    """
+    Turn an iterable of DataFrame pieces (e.g. `pd.read_csv(..., chunksize=...)`)
+    into chunks that each hold complete groups and stay under a memory limit.
+
+    Pass 1 hashes every row's group key into one of `num_partitions` spool files
+    on local disk, so all rows of a group land in the same partition whatever the
+    input order. Pass 2 reads partitions back and packs them into chunks whose
+    in-memory size stays within `memory_limit_mb / working_copies`, leaving room
+    for the copies each pipeline stage makes of a chunk.
+    """
+
+    def __init__(self, project_id, logger, group_by_columns, memory_limit_mb, num_partitions=256,
+                 working_copies=6, spool_dir=None):
+        self.project_id = project_id
+        self.logger = logger
+        self.group_by_columns = list(group_by_columns)
+        self.num_partitions = num_partitions
+        self.chunk_limit_bytes = memory_limit_mb * 1024 * 1024 / working_copies
+        self.spool_dir = spool_dir
+
+    def _hash_keys(self, frame):
+        """
+        Group key columns cast to a dtype that does not depend on the piece they came from.
+
+        read_csv infers dtypes per piece, so a numeric key with a blank cell is float64 in
+        that piece and int64 in the others, and a bool key becomes object. The hash depends
+        on the dtype, so numeric keys are hashed as float64 and bool keys as objects, which
+        is also how the pieces combine when concatenated.
+        """
+        keys = {}
+        for col in self.group_by_columns:
+            column = frame[col]
+            if types.is_bool_dtype(column.dtype):
+                column = column.astype(object)
+            elif types.is_numeric_dtype(column.dtype):
+                column = column.astype(np.float64)
+            keys[col] = column
+        return pd.DataFrame(keys)
+
+    def _partition(self, frames, spool_path):
+        """Spill every row to the partition file of its group; return bytes per partition."""
+        partition_bytes = [0] * self.num_partitions
+        for frame in frames:
+            partition_ids = pd.util.hash_pandas_object(self._hash_keys(frame), index=False) % self.num_partitions
+            for partition_id, piece in frame.groupby(partition_ids.to_numpy(), sort=False):
+                with open(os.path.join(spool_path, f"partition-{partition_id:05d}.pkl"), "ab") as handle:
+                    pickle.dump(piece, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                partition_bytes[partition_id] += int(piece.memory_usage(deep=True).sum())
+        return partition_bytes
+
+    def _load_partition(self, spool_path, partition_id):
+        pieces = []
+        with open(os.path.join(spool_path, f"partition-{partition_id:05d}.pkl"), "rb") as handle:
+            while True:
+                try:
+                    pieces.append(pickle.load(handle))
+                except EOFError:
+                    break
+        return pieces
+
+    def iter_chunks(self, frames):
+        """Yield DataFrames made of whole groups, each within the configured memory limit."""
+        spool_path = tempfile.mkdtemp(prefix="group_chunks_", dir=self.spool_dir)
+        try:
+            partition_bytes = self._partition(frames, spool_path)
+
+            pending, pending_bytes = [], 0
+            for partition_id, size in enumerate(partition_bytes):
+                if size == 0:
+                    continue
+                if pending and pending_bytes + size > self.chunk_limit_bytes:
+                    yield pd.concat(pending, ignore_index=True)
+                    pending, pending_bytes = [], 0
+                if size > self.chunk_limit_bytes:
+                    self.logger.warning(f"Partition {partition_id} holds {size / 1024 ** 2:.1f} MB of whole groups, "
+                                        f"above the per-chunk limit of {self.chunk_limit_bytes / 1024 ** 2:.1f} MB.")
+                pending.extend(self._load_partition(spool_path, partition_id))
+                pending_bytes += size
+            if pending:
+                yield pd.concat(pending, ignore_index=True)
+        finally:
+            shutil.rmtree(spool_path, ignore_errors=True)
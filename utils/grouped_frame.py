@@ -0,0 +1,146 @@
+#Grouped frame: sorted, contiguous per-group layout shared by the transformers
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+class GroupedFrame:
+    """
+    Sort a DataFrame once by its group columns (and month) and keep the numeric
+    columns as contiguous float64 arrays with group offset boundaries.
+
+    `values` has shape (n_columns, n_rows) so every column slice of a group is a
+    contiguous view; transformers modify those views in place and `write_back`
+    scatters the result to the DataFrame in a single assignment per column.
+    When `mmap_dir` is given the sorted arrays live in a file in that directory and
+    are filled and written back in blocks of rows, so the working copy is paged by
+    the OS instead of held on the heap: peak memory is the DataFrame plus one block
+    rather than the DataFrame plus a full sorted copy. The DataFrame itself still
+    has to fit in memory; out-of-core mode is the option for inputs that do not.
+    """
+
+    block_rows = 1 << 20  # Rows copied at a time between the DataFrame and a memory-mapped layout
+
+    def __init__(self, df, columns, group_by=None, month_variable=None, mmap_dir=None, rows=None):
+        self.columns = list(columns)
+        self.group_by = list(group_by) if group_by else []
+        self.month_variable = month_variable
+
+        # An optional boolean row mask restricts the layout to those rows; the others are
+        # left out (and untouched by write_back), as are rows with a missing group key
+        subset = df if rows is None else df[rows]
+        row_numbers = np.arange(len(df)) if rows is None else np.flatnonzero(rows)
+
+        if self.group_by:
+            codes = subset.groupby(self.group_by, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        else:
+            codes = np.zeros(len(subset), dtype=np.int64)
+
+        valid = np.flatnonzero(codes >= 0)
+        sort_keys = [codes[valid]]
+        if month_variable is not None:
+            month_rank = pd.factorize(subset[month_variable], sort=True)[0][valid]
+            # Missing months go to the end of their group
+            month_rank = np.where(month_rank < 0, month_rank.max(initial=0) + 1, month_rank)
+            sort_keys.insert(0, month_rank)
+        self.positions = row_numbers[valid[np.lexsort(sort_keys)]]
+
+        n_groups = int(codes.max(initial=-1)) + 1
+        counts = np.bincount(codes[valid], minlength=n_groups)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        if self.group_by:
+            self.keys = df[self.group_by].iloc[self.positions[self.offsets[:-1]]].reset_index(drop=True)
+        else:
+            self.keys = pd.DataFrame(index=range(n_groups))
+
+        # Raw month (or index) values in sorted order; converted to a numeric time axis on first use
+        if month_variable is not None:
+            self._time_source = df[month_variable].to_numpy()[self.positions]
+        else:
+            self._time_source = df.index.to_numpy()[self.positions]
+        self._time_axis = None
+
+        self._mmap_path = None
+        shape = (len(self.columns), len(self.positions))
+        if mmap_dir is not None:
+            fd, self._mmap_path = tempfile.mkstemp(suffix=".f64", dir=mmap_dir)
+            os.close(fd)
+            self.values = np.memmap(self._mmap_path, dtype=np.float64, mode="w+", shape=shape)
+        else:
+            self.values = np.empty(shape, dtype=np.float64)
+        for j, col in enumerate(self.columns):
+            if self._mmap_path is None:
+                self.values[j] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)[self.positions]
+                continue
+            for start in range(0, len(self.positions), self.block_rows):
+                block = self.positions[start:start + self.block_rows]
+                self.values[j, start:start + len(block)] = df[col].iloc[block].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    @property
+    def n_groups(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return self.n_groups
+
+    def iter_groups(self):
+        """Yield (group number, start, stop) for every group."""
+        for i in range(self.n_groups):
+            yield i, self.offsets[i], self.offsets[i + 1]
+
+    def group_key(self, i):
+        """Return the group key of group `i` as a tuple."""
+        return tuple(self.keys.iloc[i])
+
+    def block(self, i):
+        """Zero-copy (n_columns, group_length) view of group `i`."""
+        return self.values[:, self.offsets[i]:self.offsets[i + 1]]
+
+    def column_slice(self, column, i):
+        """Zero-copy 1-D view of one column of group `i`."""
+        return self.values[self.columns.index(column), self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def time_axis(self):
+        """Position along the time axis of each row, used by interpolating methods."""
+        if self._time_axis is None:
+            if self.month_variable is not None:
+                self._time_axis = pd.to_datetime(self._time_source).to_numpy().astype(np.int64)
+            else:
+                self._time_axis = self._time_source.astype(np.int64)
+        return self._time_axis
+
+    def sorted_column(self, df, column):
+        """Values of any column of `df` (numeric or not) in the grouped row order."""
+        return df[column].to_numpy()[self.positions]
+
+    def group_time_axis(self, i):
+        return self.time_axis[self.offsets[i]:self.offsets[i + 1]]
+
+    def write_back(self, df, columns=None):
+        """Scatter the (possibly modified) arrays back into the rows of `df` they came from."""
+        for col in (columns or self.columns):
+            source = self.values[self.columns.index(col)]
+            if self._mmap_path is None:
+                updated = df[col].to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+                updated[self.positions] = source
+                df[col] = updated
+                continue
+            # Memory-mapped: assign block by block into the float64 column instead of building a full copy
+            if df[col].dtype != np.float64:
+                df[col] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            column_number = df.columns.get_loc(col)
+            for start in range(0, len(self.positions), self.block_rows):
+                block = self.positions[start:start + self.block_rows]
+                df.iloc[block, column_number] = source[start:start + len(block)]
+        return df
+
+    def close(self):
+        """Release the memory-mapped backing file, if any."""
+        if self._mmap_path is not None:
+            del self.values
+            os.remove(self._mmap_path)
+            self._mmap_path = None
@@ -1,63 +1,95 @@
 import numpy as np
 import pandas as pd
-from sklearn.impute import SimpleImputer, KNNImputer
+from sklearn.impute import KNNImputer
 from scipy.interpolate import UnivariateSpline
 
+from .grouped_frame import GroupedFrame
+from .segment_kernels import broadcast, segment_bfill, segment_ffill, segment_mean, segment_median
+from . import transformer_state
+from .data_quality import rows_needing
+
 class TimeSeriesMissingValueHandler:
-    def __init__(self, project_id: str, logger, method='linear', k_neighbors=5):
+    def __init__(self, project_id: str, logger, method='linear', k_neighbors=5, mmap_dir=None):
         self.project_id = project_id
         self.logger = logger  # Logger instance for logging operations
         self.method = method
         self.k_neighbors = k_neighbors
+        self.mmap_dir = mmap_dir  # Optional directory for memory-mapped group arrays
+
+    def _mean_imputation(self, values, offsets):
+        before_imputation = np.isnan(values).sum(axis=1)
+        group_means = segment_mean(values, offsets)
+        np.copyto(values, broadcast(group_means, offsets), where=np.isnan(values))
+        after_imputation = np.isnan(values).sum(axis=1)
+        return values, before_imputation, after_imputation
 
-    def _mean_imputation(self, df, columns):
-        imputer = SimpleImputer(strategy='mean')
-        before_imputation = df[columns].isna().sum()
-        df[columns] = imputer.fit_transform(df[columns])
-        after_imputation = df[columns].isna().sum()
-        return df, before_imputation, after_imputation
-
-    def _median_imputation(self, df, columns):
-        imputer = SimpleImputer(strategy='median')
-        before_imputation = df[columns].isna().sum()
-        df[columns] = imputer.fit_transform(df[columns])
-        after_imputation = df[columns].isna().sum()
-        return df, before_imputation, after_imputation
-
-    def _ffill_bfill(self, df, columns, method='ffill'):
+    def _median_imputation(self, values, offsets):
+        before_imputation = np.isnan(values).sum(axis=1)
+        group_medians = segment_median(values, offsets)
+        np.copyto(values, broadcast(group_medians, offsets), where=np.isnan(values))
+        after_imputation = np.isnan(values).sum(axis=1)
+        return values, before_imputation, after_imputation
+
+    def _ffill_bfill(self, values, offsets, method='ffill'):
         if method not in ['ffill', 'bfill']:
             raise ValueError("Method should be 'ffill' or 'bfill'.")
-        before_imputation = df[columns].isna().sum()
-        df[columns] = df[columns].fillna(method=method)
-        after_imputation = df[columns].isna().sum()
-        return df, before_imputation, after_imputation
+        before_imputation = np.isnan(values).sum(axis=1)
+        values[:] = segment_ffill(values, offsets) if method == 'ffill' else segment_bfill(values, offsets)
+        after_imputation = np.isnan(values).sum(axis=1)
+        return values, before_imputation, after_imputation
 
-    def _knn_imputation(self, df, columns):
+    def _knn_imputation(self, values):
         imputer = KNNImputer(n_neighbors=self.k_neighbors)
-        before_imputation = df[columns].isna().sum()
-        df[columns] = imputer.fit_transform(df[columns])
-        after_imputation = df[columns].isna().sum()
-        return df, before_imputation, after_imputation
-
-    def _spline_interpolation(self, df, columns):
-        before_imputation = df[columns].isna().sum()
-        for col in columns:
-            if df[col].dtype.kind in 'fi' and df[col].notna().sum() > 0:
-                x = df.index.astype(np.int64)
-                y = df[col].values
-                valid_indices = ~np.isnan(y)
-                spline = UnivariateSpline(x[valid_indices], y[valid_indices], k=3, s=0)
-                df[col] = spline(x)
-        after_imputation = df[columns].isna().sum()
-        return df, before_imputation, after_imputation
-
-    def _linear_interpolation(self, df, columns):
-        before_imputation = df[columns].isna().sum()
-        df[columns] = df[columns].interpolate(method='linear')
-        after_imputation = df[columns].isna().sum()
-        return df, before_imputation, after_imputation
-
-    def impute_missing_values(self, df, columns, group_by=None, method=None):
+        before_imputation = np.isnan(values).sum(axis=1)
+        values[:] = imputer.fit_transform(values.T).T
+        after_imputation = np.isnan(values).sum(axis=1)
+        return values, before_imputation, after_imputation
+
+    def _spline_interpolation(self, values, x):
+        before_imputation = np.isnan(values).sum(axis=1)
+        for row in values:
+            valid_indices = ~np.isnan(row)
+            if valid_indices.sum() > 0:
+                spline = UnivariateSpline(x[valid_indices], row[valid_indices], k=3, s=0)
+                row[:] = spline(x)
+        after_imputation = np.isnan(values).sum(axis=1)
+        return values, before_imputation, after_imputation
+
+    def _linear_interpolation(self, values):
+        before_imputation = np.isnan(values).sum(axis=1)
+        positions = np.arange(values.shape[1])
+        for row in values:
+            valid_indices = ~np.isnan(row)
+            if valid_indices.any() and not valid_indices.all():
+                # Like DataFrame.interpolate: leading gaps stay missing, trailing gaps take the last value
+                first_valid = np.argmax(valid_indices)
+                filled = np.interp(positions, positions[valid_indices], row[valid_indices])
+                row[first_valid:] = filled[first_valid:]
+        after_imputation = np.isnan(values).sum(axis=1)
+        return values, before_imputation, after_imputation
+
+    def _impute_groups(self, grouped, method):
+        """Apply the imputation method in place to every group of a GroupedFrame."""
+        # Statistics and fills run over all groups at once through the segment kernels
+        if method == 'mean':
+            return self._mean_imputation(grouped.values, grouped.offsets)
+        elif method == 'median':
+            return self._median_imputation(grouped.values, grouped.offsets)
+        elif method in ['ffill', 'bfill']:
+            return self._ffill_bfill(grouped.values, grouped.offsets, method=method)
+
+        if method not in ['knn', 'spline', 'linear']:
+            raise ValueError("Invalid method. Choose from 'mean', 'median', 'ffill', 'bfill', 'knn', 'spline', 'linear'.")
+        # Model-based methods are fitted per group on zero-copy slices
+        for i, start, stop in grouped.iter_groups():
+            if method == 'knn':
+                self._knn_imputation(grouped.block(i))
+            elif method == 'spline':
+                self._spline_interpolation(grouped.block(i), grouped.group_time_axis(i))
+            else:
+                self._linear_interpolation(grouped.block(i))
+
+    def impute_missing_values(self, df, columns, group_by=None, method=None, month_variable=None, quality_index=None):
         """
         Impute missing values in the DataFrame based on the specified method and group.
 
@@ -72,6 +104,11 @@ class TimeSeriesMissingValueHandler:
         method : str, optional
             Method to use for imputation. If None, uses the method specified during initialization.
             Options are 'mean', 'median', 'ffill', 'bfill', 'knn', 'spline', 'linear'.
+        month_variable : str, optional
+            Month column used to order rows within each group. If None, the original row order is kept
+            and the index is used as the time axis for spline interpolation.
+        quality_index : pandas.DataFrame, optional
+            Quality index from DataQualityScanner; only groups flagged `needs_imputation` are processed.
 
         Returns:
         --------
@@ -84,44 +121,84 @@ class TimeSeriesMissingValueHandler:
         if group_by:
             # Create a copy of the DataFrame to avoid SettingWithCopyWarning
             df = df.copy()
-            # Group by specified columns
-            grouped = df.groupby(group_by)
-
-            for name, group in grouped:
-                # Apply imputation method on each group
-                if method == 'mean':
-                    group, before, after = self._mean_imputation(group, columns)
-                elif method == 'median':
-                    group, before, after = self._median_imputation(group, columns)
-                elif method in ['ffill', 'bfill']:
-                    group, before, after = self._ffill_bfill(group, columns, method=method)
-                elif method == 'knn':
-                    group, before, after = self._knn_imputation(group, columns)
-                elif method == 'spline':
-                    group, before, after = self._spline_interpolation(group, columns)
-                elif method == 'linear':
-                    group, before, after = self._linear_interpolation(group, columns)
-                else:
-                    raise ValueError("Invalid method. Choose from 'mean', 'median', 'ffill', 'bfill', 'knn', 'spline', 'linear'.")
-
-                # Update the original DataFrame with imputed values
-                df.loc[group.index, columns] = group[columns]
 
+        # Sort once and impute every group on the shared arrays;
+        # without group_by the whole frame is a single group in its original order
+        rows = None if quality_index is None else rows_needing(df, quality_index, 'needs_imputation', group_by)
+        grouped = GroupedFrame(df, columns, group_by=group_by, month_variable=month_variable, mmap_dir=self.mmap_dir, rows=rows)
+        try:
+            self._impute_groups(grouped, method)
+            grouped.write_back(df)
+        finally:
+            grouped.close()
+
+        return df
+
+    def fit(self, df, columns, group_by=None, method=None, month_variable=None):
+        """
+        Compute per-group imputation statistics without imputing.
+
+        'mean' and 'median' store one fill value per group and column. The other methods
+        fill gaps from neighbouring rows of the data being imputed, so only the method and
+        grouping are stored and transform runs them on the new data.
+        """
+        if method is None:
+            method = self.method
+
+        self.fitted_method_ = method
+        self.columns_ = list(columns)
+        self.group_by_ = list(group_by) if group_by else []
+        self.month_variable_ = month_variable
+        self.fill_values_ = None
+        if method in ['mean', 'median']:
+            grouped = GroupedFrame(df, columns, group_by=group_by, mmap_dir=self.mmap_dir)
+            try:
+                reduce = segment_mean if method == 'mean' else segment_median
+                self.fill_values_ = reduce(grouped.values, grouped.offsets)
+            finally:
+                grouped.close()
+            self.group_keys_ = grouped.keys
         else:
-            # No grouping, apply directly to the DataFrame
-            if method == 'mean':
-                df, before, after = self._mean_imputation(df, columns)
-            elif method == 'median':
-                df, before, after = self._median_imputation(df, columns)
-            elif method in ['ffill', 'bfill']:
-                df, before, after = self._ffill_bfill(df, columns, method=method)
-            elif method == 'knn':
-                df, before, after = self._knn_imputation(df, columns)
-            elif method == 'spline':
-                df, before, after = self._spline_interpolation(df, columns)
-            elif method == 'linear':
-                df, before, after = self._linear_interpolation(df, columns)
-            else:
-                raise ValueError("Invalid method. Choose from 'mean', 'median', 'ffill', 'bfill', 'knn', 'spline', 'linear'.")
+            self.group_keys_ = pd.DataFrame(columns=self.group_by_)
+        return self
+
+    def transform(self, df, quality_index=None):
+        """
+        Impute with the fitted statistics by group lookup; unknown groups are left unchanged.
 
+        Methods without stored statistics are run on `df`, restricted to the groups flagged
+        `needs_imputation` when a quality index is given.
+        """
+        # The caller's frame is never modified, whichever method was fitted
+        df = df.copy()
+        if self.fill_values_ is None:
+            return self.impute_missing_values(df, self.columns_, group_by=self.group_by_, method=self.fitted_method_,
+                                              month_variable=self.month_variable_, quality_index=quality_index)
+        positions = transformer_state.lookup_groups(df, self.group_keys_)
+        unknown_rows = int((positions < 0).sum())
+        if unknown_rows and self.logger is not None:
+            self.logger.warning(f"{unknown_rows} rows belong to groups without fitted imputation statistics and are left unchanged.")
+        for j, col in enumerate(self.columns_):
+            values = df[col].to_numpy(dtype=np.float64, copy=True)
+            missing = np.isnan(values)
+            values[missing] = transformer_state.gather(self.fill_values_[j], positions)[missing]
+            df[col] = values
         return df
+
+    def save_state(self, path):
+        """Save the fitted imputation statistics to a compact binary artifact."""
+        metadata = {'transformer': 'TimeSeriesMissingValueHandler', 'method': self.fitted_method_,
+                    'columns': self.columns_, 'group_by': self.group_by_, 'month_variable': self.month_variable_,
+                    'k_neighbors': self.k_neighbors}
+        arrays = {} if self.fill_values_ is None else {'fill_values': self.fill_values_}
+        transformer_state.save_state(path, metadata, self.group_keys_, **arrays)
+
+    def load_state(self, paths):
+        """Load fitted imputation statistics from one or more artifacts written by save_state."""
+        metadata, group_keys, arrays = transformer_state.load_state(paths)
+        self.fitted_method_, self.columns_ = metadata['method'], metadata['columns']
+        self.group_by_, self.month_variable_ = metadata['group_by'], metadata['month_variable']
+        self.k_neighbors = metadata['k_neighbors']
+        self.group_keys_ = group_keys
+        self.fill_values_ = arrays.get('fill_values')
+        return self
@@ -0,0 +1,207 @@
+#Segment kernels: per-group reductions over sorted group-offset arrays
+import numpy as np
+
+try:
+    from numba import njit
+except ModuleNotFoundError:
+    njit = None
+
+# Every kernel takes `values` shaped (n_columns, n_rows), sorted so that group g
+# occupies rows offsets[g]:offsets[g + 1], and returns (n_columns, n_groups).
+# Missing values (NaN) are skipped, as pandas does. Quantiles and fills use the
+# numba-compiled loops when numba is installed and pure NumPy otherwise.
+
+
+def _lengths(offsets):
+    return np.diff(offsets)
+
+
+def _segment_ids(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), _lengths(offsets))
+
+
+def _reduceat(ufunc, values, offsets, identity):
+    """ufunc.reduceat over the segments that also handles empty segments."""
+    n_groups = len(offsets) - 1
+    result = np.full((values.shape[0], n_groups), identity, dtype=values.dtype)
+    non_empty = _lengths(offsets) > 0
+    if non_empty.any():
+        result[:, non_empty] = ufunc.reduceat(values, offsets[:-1][non_empty], axis=1)
+    return result
+
+
+def broadcast(stats, offsets):
+    """Expand per-group statistics (..., n_groups) back to one value per row."""
+    return np.repeat(stats, _lengths(offsets), axis=-1)
+
+
+def segment_count(values, offsets):
+    """Number of non-missing values per group."""
+    return _reduceat(np.add, (~np.isnan(values)).astype(np.int64), offsets, 0)
+
+
+def segment_sum(values, offsets):
+    return _reduceat(np.add, np.where(np.isnan(values), 0.0, values), offsets, 0.0)
+
+
+def segment_mean(values, offsets):
+    counts = segment_count(values, offsets)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, segment_sum(values, offsets) / counts, np.nan)
+
+
+def segment_std(values, offsets, ddof=0):
+    """Standard deviation per group (population by default, like scipy.stats.zscore)."""
+    counts = segment_count(values, offsets)
+    deviations = values - broadcast(segment_mean(values, offsets), offsets)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = segment_sum(deviations ** 2, offsets) / (counts - ddof)
+    return np.where(counts - ddof > 0, np.sqrt(variance), np.nan)
+
+
+def segment_min(values, offsets):
+    return _segment_extreme(values, offsets, np.minimum)
+
+
+def segment_max(values, offsets):
+    return _segment_extreme(values, offsets, np.maximum)
+
+
+def _segment_extreme(values, offsets, ufunc):
+    """Missing-aware min/max for float and datetime64 values."""
+    is_datetime = values.dtype.kind == 'M'
+    if is_datetime:
+        missing = np.isnat(values)
+        data = values.view(np.int64)
+        sentinel = np.iinfo(np.int64).max if ufunc is np.minimum else np.iinfo(np.int64).min + 1
+    else:
+        missing = np.isnan(values)
+        data = values
+        sentinel = np.inf if ufunc is np.minimum else -np.inf
+    result = _reduceat(ufunc, np.where(missing, sentinel, data), offsets, sentinel)
+    empty = _reduceat(np.add, (~missing).astype(np.int64), offsets, 0) == 0
+    if is_datetime:
+        result = result.view(values.dtype)
+        result[empty] = np.datetime64('NaT')
+    else:
+        result[empty] = np.nan
+    return result
+
+
+def _lerp(low, high, fraction):
+    # Same formulation as numpy's linear quantile interpolation
+    diff = high - low
+    return np.where(fraction >= 0.5, high - diff * (1 - fraction), low + diff * fraction)
+
+
+def _segment_quantile_numpy(values, offsets, quantiles):
+    n_groups = len(offsets) - 1
+    segment_ids = _segment_ids(offsets)
+    starts = offsets[:-1]
+    result = np.full((len(quantiles), values.shape[0], n_groups), np.nan)
+    for j, column in enumerate(values):
+        # Sort within each segment; NaN sorts last so the valid values lead each segment
+        ordered = column[np.lexsort((column, segment_ids))]
+        n_valid = segment_count(column[np.newaxis], offsets)[0]
+        has_values = n_valid > 0
+        for k, q in enumerate(quantiles):
+            position = q * (n_valid[has_values] - 1)
+            low = np.floor(position).astype(np.int64)
+            high = np.minimum(low + 1, n_valid[has_values] - 1)
+            result[k, j, has_values] = _lerp(ordered[starts[has_values] + low],
+                                             ordered[starts[has_values] + high],
+                                             position - low)
+    return result
+
+
+def _segment_ffill_numpy(values, offsets):
+    positions = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    last_valid = np.where(np.isnan(values), -1, positions)
+    np.maximum.accumulate(last_valid, axis=1, out=last_valid)
+    # A fill may not cross into the previous group
+    within_group = last_valid >= broadcast(offsets[:-1], offsets)
+    filled = np.take_along_axis(values, np.maximum(last_valid, 0), axis=1)
+    return np.where(within_group, filled, np.nan)
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _segment_quantile_numba(values, offsets, quantiles):
+        n_columns = values.shape[0]
+        n_groups = len(offsets) - 1
+        result = np.full((len(quantiles), n_columns, n_groups), np.nan)
+        for j in range(n_columns):
+            for g in range(n_groups):
+                segment = values[j, offsets[g]:offsets[g + 1]]
+                ordered = np.sort(segment[~np.isnan(segment)])
+                n_valid = len(ordered)
+                if n_valid == 0:
+                    continue
+                for k in range(len(quantiles)):
+                    position = quantiles[k] * (n_valid - 1)
+                    low = int(np.floor(position))
+                    high = min(low + 1, n_valid - 1)
+                    fraction = position - low
+                    diff = ordered[high] - ordered[low]
+                    if fraction >= 0.5:
+                        result[k, j, g] = ordered[high] - diff * (1 - fraction)
+                    else:
+                        result[k, j, g] = ordered[low] + diff * fraction
+        return result
+
+    @njit(cache=True)
+    def _segment_ffill_numba(values, offsets):
+        result = values.copy()
+        for j in range(values.shape[0]):
+            for g in range(len(offsets) - 1):
+                last = np.nan
+                for i in range(offsets[g], offsets[g + 1]):
+                    if np.isnan(result[j, i]):
+                        result[j, i] = last
+                    else:
+                        last = result[j, i]
+        return result
+
+
+def segment_quantile(values, offsets, q):
+    """
+    Linear-interpolated quantile(s) per group, matching pandas/numpy defaults.
+
+    Returns (n_columns, n_groups) for a scalar `q` and (len(q), n_columns, n_groups)
+    for a sequence, sorting each group only once.
+    """
+    quantiles = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if njit is not None:
+        result = _segment_quantile_numba(values, offsets, quantiles)
+    else:
+        result = _segment_quantile_numpy(values, offsets, quantiles)
+    return result[0] if np.ndim(q) == 0 else result
+
+
+def segment_median(values, offsets):
+    return segment_quantile(values, offsets, 0.5)
+
+
+def segment_mad(values, offsets, median=None):
+    """Median absolute deviation from the group median."""
+    if median is None:
+        median = segment_median(values, offsets)
+    return segment_median(np.abs(values - broadcast(median, offsets)), offsets)
+
+
+def segment_ffill(values, offsets):
+    """Forward fill missing values without crossing group boundaries."""
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if njit is not None:
+        return _segment_ffill_numba(values, offsets)
+    return _segment_ffill_numpy(values, offsets)
+
+
+def segment_bfill(values, offsets):
+    """Backward fill missing values without crossing group boundaries."""
+    n_rows = values.shape[1]
+    reversed_offsets = (n_rows - np.asarray(offsets, dtype=np.int64))[::-1]
+    return segment_ffill(values[:, ::-1], reversed_offsets)[:, ::-1]
@@ -0,0 +1,215 @@
+#Sharded output: parallel, compressed multi-part CSV files with a manifest
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', None: ''}
+
+
+def manifest_path(output_path):
+    return f"{output_path}.manifest.json"
+
+
+def _compress(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def _decompress(data, compression):
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+class LocalFileStore:
+    """Stand-in for GCS that keeps objects under `root/<bucket>/<path>` on the local filesystem."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _full_path(self, bucket_name, path):
+        return os.path.join(self.root, bucket_name, path)
+
+    def put(self, bucket_name, path, data):
+        full_path = self._full_path(bucket_name, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as handle:
+            handle.write(data)
+
+    def get(self, bucket_name, path):
+        with open(self._full_path(bucket_name, path), 'rb') as handle:
+            return handle.read()
+
+    def exists(self, bucket_name, path):
+        return os.path.exists(self._full_path(bucket_name, path))
+
+
+class GCSStore:
+    """Raw-bytes access to GCS objects through the google-cloud-storage client."""
+
+    def __init__(self, project_id):
+        from google.cloud import storage
+        self.client = storage.Client(project=project_id)
+
+    def put(self, bucket_name, path, data):
+        self.client.bucket(bucket_name).blob(path).upload_from_string(data)
+
+    def get(self, bucket_name, path):
+        return self.client.bucket(bucket_name).blob(path).download_as_bytes()
+
+    def exists(self, bucket_name, path):
+        return self.client.bucket(bucket_name).blob(path).exists()
+
+
+class ShardedWriter:
+    """
+    Write a DataFrame as N compressed CSV part files plus a JSON manifest.
+
+    Parts are serialized, compressed and uploaded in parallel. The manifest lists
+    every part with its row count and SHA-256 checksum and is written last, so a
+    reader never sees a partially written output. `write_data` has the same
+    signature as GCSWriter.write_data and can be used in its place.
+    """
+
+    def __init__(self, project_id, logger, store, rows_per_part=500000, num_parts=None, compression='gzip', max_workers=8):
+        if compression not in _EXTENSIONS:
+            raise ValueError("Invalid compression. Choose from 'gzip', 'zstd' or None.")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' package.")
+        self.project_id = project_id
+        self.logger = logger
+        self.store = store
+        self.rows_per_part = rows_per_part
+        self.num_parts = num_parts
+        self.compression = compression
+        self.max_workers = max_workers
+
+    def _write_part(self, part_df, bucket_name, path, write_index):
+        data = _compress(part_df.to_csv(index=write_index).encode('utf-8'), self.compression)
+        self.store.put(bucket_name, path, data)
+        return {'path': path, 'rows': len(part_df), 'bytes': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+
+    def write_data(self, df, bucket_name, output_path, is_overwrite=True):
+        """
+        Write `df` as part files under `output_path` and return the manifest.
+
+        Like GCSWriter.write_data, every failure is raised as RuntimeError.
+        """
+        try:
+            return self._write_data(df, bucket_name, output_path, is_overwrite)
+        except RuntimeError:
+            raise
+        except Exception as e:
+            # Store errors (OSError, google-cloud exceptions) from any part upload
+            raise RuntimeError(f"Failed to write gs://{bucket_name}/{output_path}: {e}") from e
+
+    def _write_data(self, df, bucket_name, output_path, is_overwrite):
+        if not is_overwrite and self.store.exists(bucket_name, manifest_path(output_path)):
+            raise RuntimeError(f"Output already exists: gs://{bucket_name}/{manifest_path(output_path)}")
+
+        num_parts = self.num_parts or max(1, math.ceil(len(df) / self.rows_per_part))
+        bounds = [round(i * len(df) / num_parts) for i in range(num_parts + 1)]
+        # A meaningful index (e.g. the group keys of the lambda table) is written with the data
+        write_index = not isinstance(df.index, pd.RangeIndex)
+        suffix = '.csv' + _EXTENSIONS[self.compression]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._write_part, df.iloc[bounds[i]:bounds[i + 1]], bucket_name,
+                                       f"{output_path}.part-{i:05d}{suffix}", write_index)
+                       for i in range(num_parts)]
+            parts = [future.result() for future in futures]
+
+        manifest = {
+            'format': 'csv',
+            'compression': self.compression,
+            'total_rows': len(df),
+            'columns': [str(col) for col in df.columns],
+            'index_levels': df.index.nlevels if write_index else 0,
+            'parts': parts,
+        }
+        self.store.put(bucket_name, manifest_path(output_path), json.dumps(manifest, indent=2).encode('utf-8'))
+        self.logger.info(f"Wrote {num_parts} parts ({len(df)} rows) to gs://{bucket_name}/{output_path}")
+        return manifest
+
+
+class ShardedReader:
+    """Read outputs written by ShardedWriter, fetching and parsing parts concurrently."""
+
+    def __init__(self, project_id, logger, store, max_workers=8):
+        self.project_id = project_id
+        self.logger = logger
+        self.store = store
+        self.max_workers = max_workers
+
+    def read_manifest(self, path, bucket_name):
+        return json.loads(self.store.get(bucket_name, manifest_path(path)).decode('utf-8'))
+
+    def _read_part(self, part, bucket_name, manifest, read_kwargs):
+        data = self.store.get(bucket_name, part['path'])
+        if hashlib.sha256(data).hexdigest() != part['sha256']:
+            raise ValueError(f"Checksum mismatch for gs://{bucket_name}/{part['path']}")
+        index_col = list(range(manifest['index_levels'])) or None
+        return pd.read_csv(io.BytesIO(_decompress(data, manifest['compression'])), index_col=index_col, **read_kwargs)
+
+    def iter_parts(self, path, bucket_name, **read_kwargs):
+        """Yield the parts one at a time, in order, for bounded-memory processing."""
+        manifest = self.read_manifest(path, bucket_name)
+        for part in manifest['parts']:
+            yield self._read_part(part, bucket_name, manifest, read_kwargs)
+
+    def read_data(self, path, bucket_name, **read_kwargs):
+        """Read every part concurrently and concatenate them in order; same signature as GCSReader.read_data."""
+        manifest = self.read_manifest(path, bucket_name)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            parts = list(executor.map(lambda part: self._read_part(part, bucket_name, manifest, read_kwargs), manifest['parts']))
+        df = pd.concat(parts, ignore_index=manifest['index_levels'] == 0)
+        if len(df) != manifest['total_rows']:
+            raise ValueError(f"Expected {manifest['total_rows']} rows in gs://{bucket_name}/{path}, read {len(df)}")
+        return df
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def shared_store(project_id, local_root=None):
+    """One store per project (or local root), reused by every reader and writer in the process."""
+    key = ('local', local_root) if local_root else ('gcs', project_id)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = LocalFileStore(local_root) if local_root else GCSStore(project_id)
+        return _stores[key]
+
+
+def sharded_clients(project_id, logger, settings):
+    """
+    Build a (ShardedReader, ShardedWriter) pair from the `sharded_output` config section.
+
+    Objects go to GCS unless `local_root` is set, in which case they are kept under
+    that local directory instead (useful for development and tests). The underlying
+    store, and so the storage client, is shared by every pair built for the same project.
+    """
+    store = shared_store(project_id, settings.get('local_root'))
+    max_workers = settings.get('max_workers', 8)
+    reader = ShardedReader(project_id, logger, store, max_workers=max_workers)
+    writer = ShardedWriter(project_id, logger, store, rows_per_part=settings.get('rows_per_part', 500000),
+                           num_parts=settings.get('num_parts'), compression=settings.get('compression', 'gzip'),
+                           max_workers=max_workers)
+    return reader, writer
@@ -1,115 +1,185 @@
 import numpy as np
 import pandas as pd
-from scipy import stats
-from sklearn.preprocessing import RobustScaler
+
+from .grouped_frame import GroupedFrame
+from .segment_kernels import broadcast, segment_mad, segment_mean, segment_median, segment_quantile, segment_std
+from . import transformer_state
+from .data_quality import rows_needing
 
 class TimeSeriesOutlierHandler:
-    def __init__(self, project_id, logger=None, method='zscore', threshold=3.0):
+    def __init__(self, project_id, logger=None, method='zscore', threshold=3.0, mmap_dir=None):
         self.project_id = project_id
         self.logger = logger
         self.method = method
         self.threshold = threshold
+        self.mmap_dir = mmap_dir  # Optional directory for memory-mapped group arrays
+
+    # Detection and treatment work on (columns, rows) arrays whose groups are delimited by `offsets`
 
-    def _zscore_outlier_detection(self, df, columns):
-        z_scores = np.abs(stats.zscore(df[columns], nan_policy='omit'))
-        return (z_scores > self.threshold)
+    def group_statistics(self, values, offsets, method):
+        """
+        Per-group outlier bounds and replacement values, each shaped (columns, groups).
 
-    def _iqr_outlier_detection(self, df, columns):
-        outliers = pd.DataFrame(index=df.index)
-        for col in columns:
-            Q1 = df[col].quantile(0.25)
-            Q3 = df[col].quantile(0.75)
+        Values strictly outside [lower, upper] are outliers. All groups and columns are
+        computed at once with the segment kernels.
+        """
+        if method == 'zscore':
+            # |z| > threshold with z = (x - mean) / std (population std, as scipy.stats.zscore)
+            mean, std = segment_mean(values, offsets), segment_std(values, offsets)
+            lower, upper = mean - self.threshold * std, mean + self.threshold * std
+            replacement = segment_median(values, offsets)
+        elif method == 'iqr':
+            Q1, Q3 = segment_quantile(values, offsets, [0.25, 0.75])
             IQR = Q3 - Q1
-            outliers[col] = (df[col] < (Q1 - 1.5 * IQR)) | (df[col] > (Q3 + 1.5 * IQR))
-        return outliers
+            lower, upper = Q1 - 1.5 * IQR, Q3 + 1.5 * IQR
+            replacement = (Q1 + Q3) / 2
+        elif method == 'robust_scaler':
+            # Robust scaling divides by the IQR, which cancels out of the comparison
+            # |scaled - median(scaled)| > 3 * MAD(scaled), so it is done on the raw values
+            median = segment_median(values, offsets)
+            mad = segment_mad(values, offsets, median=median)
+            lower, upper = median - 3 * mad, median + 3 * mad
+            replacement = median
+        elif method == 'rolling':
+            raise ValueError("The 'rolling' method depends on neighbouring rows and has no group statistics.")
+        else:
+            raise ValueError("Invalid method. Choose from 'zscore', 'iqr', 'rolling', 'robust_scaler'.")
+        return lower, upper, replacement
 
-    def _rolling_outlier_detection(self, df, columns, window=5, sigma=3.0):
-        outliers = pd.DataFrame(index=df.index, columns=columns)
-        for col in columns:
-            rolling_mean = df[col].rolling(window=window, min_periods=1).mean()
-            rolling_std = df[col].rolling(window=window, min_periods=1).std()
-            outliers[col] = np.abs(df[col] - rolling_mean) > (sigma * rolling_std)
+    def _rolling_outlier_detection(self, values, offsets, window=5, sigma=3.0):
+        outliers = np.zeros(values.shape, dtype=bool)
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            series = pd.DataFrame(values[:, start:stop].T)
+            rolling_mean = series.rolling(window=window, min_periods=1).mean().to_numpy().T
+            rolling_std = series.rolling(window=window, min_periods=1).std().to_numpy().T
+            outliers[:, start:stop] = np.abs(values[:, start:stop] - rolling_mean) > (sigma * rolling_std)
         return outliers
 
-    def _robust_scaler_outlier_detection(self, df, columns):
-        scaler = RobustScaler()
-        scaled_data = scaler.fit_transform(df[columns])
-        median = np.median(scaled_data, axis=0)
-        mad = np.median(np.abs(scaled_data - median), axis=0)
-        outliers = np.abs(scaled_data - median) > (3 * mad)
-        return pd.DataFrame(outliers, index=df.index, columns=columns)
-
-    def _outlier_treatment(self, df, outliers, columns, method, group_by=None):
-        if method == 'zscore' or method == 'robust_scaler':
-            if group_by:
-                for name, group in df.groupby(group_by):
-                    for col in columns:
-                        median_value = group[col].median()
-                        df.loc[outliers[col] & (df.index.isin(group.index)), col] = median_value
-            else:
-                for col in columns:
-                    median_value = df[col].median()
-                    df.loc[outliers[col], col] = median_value
+    def _rolling_outlier_treatment(self, values, outliers, offsets):
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            rolling_median = pd.DataFrame(values[:, start:stop].T).rolling(window=5, min_periods=1).median().to_numpy().T
+            np.copyto(values[:, start:stop], rolling_median, where=outliers[:, start:stop])
+        return values
 
-        elif method == 'iqr':
-            if group_by:
-                for name, group in df.groupby(group_by):
-                    for col in columns:
-                        Q1 = group[col].quantile(0.25)
-                        Q3 = group[col].quantile(0.75)
-                        median_value = (Q1 + Q3) / 2
-                        df.loc[outliers[col] & (df.index.isin(group.index)), col] = median_value
-            else:
-                for col in columns:
-                    Q1 = df[col].quantile(0.25)
-                    Q3 = df[col].quantile(0.75)
-                    median_value = (Q1 + Q3) / 2
-                    df.loc[outliers[col], col] = median_value
+    def _detect_and_treat(self, values, offsets, method, **kwargs):
+        """Detect outliers and replace them in place in one pass; returns the outlier mask."""
+        if method == 'rolling':
+            window = kwargs.get('window', 5)
+            sigma = kwargs.get('sigma', 3.0)
+            outliers = self._rolling_outlier_detection(values, offsets, window=window, sigma=sigma)
+            self._rolling_outlier_treatment(values, outliers, offsets)
+            return outliers
 
-        elif method == 'rolling':
-            for col in columns:
-                rolling_median = df[col].rolling(window=5, min_periods=1).median()
-                df.loc[outliers[col], col] = rolling_median[outliers[col]]
-                
-        return df
+        lower, upper, replacement = self.group_statistics(values, offsets, method)
+        outliers = (values < broadcast(lower, offsets)) | (values > broadcast(upper, offsets))
+        np.copyto(values, broadcast(replacement, offsets), where=outliers)
+        return outliers
+
+    def detect_and_treat(self, df, columns, group_by=None, method=None, month_variable=None, quality_index=None, **kwargs):
+        """
+        Detect and treat outliers in the same pass.
 
-    def handle_outliers(self, df, columns, group_by=None, method=None, **kwargs):
+        With a quality index from DataQualityScanner only groups flagged
+        `needs_outlier_treatment` are processed; the others are left as they are.
+
+        Returns:
+        --------
+        (treated_df, outlier_mask) where outlier_mask is a boolean DataFrame over `columns`
+        aligned with df's index (rows without a group key are never flagged).
+        """
         if method is None:
             method = self.method
 
         if group_by:
             df = df.copy()
-            grouped = df.groupby(group_by)
-
-            for name, group in grouped:
-                if method == 'zscore':
-                    outliers = self._zscore_outlier_detection(group, columns)
-                elif method == 'iqr':
-                    outliers = self._iqr_outlier_detection(group, columns)
-                elif method == 'rolling':
-                    window = kwargs.get('window', 5)
-                    sigma = kwargs.get('sigma', 3.0)
-                    outliers = self._rolling_outlier_detection(group, columns, window=window, sigma=sigma)
-                elif method == 'robust_scaler':
-                    outliers = self._robust_scaler_outlier_detection(group, columns)
-                else:
-                    raise ValueError("Invalid method. Choose from 'zscore', 'iqr', 'rolling', 'robust_scaler'.")
-
-                df.loc[group.index, columns] = self._outlier_treatment(group, outliers, columns, method, group_by)
-        else:
-            if method == 'zscore':
-                outliers = self._zscore_outlier_detection(df, columns)
-            elif method == 'iqr':
-                outliers = self._iqr_outlier_detection(df, columns)
-            elif method == 'rolling':
-                window = kwargs.get('window', 5)
-                sigma = kwargs.get('sigma', 3.0)
-                outliers = self._rolling_outlier_detection(df, columns, window=window, sigma=sigma)
-            elif method == 'robust_scaler':
-                outliers = self._robust_scaler_outlier_detection(df, columns)
-            else:
-                raise ValueError("Invalid method. Choose from 'zscore', 'iqr', 'rolling', 'robust_scaler'.")
-
-            df = self._outlier_treatment(df, outliers, columns, method)
 
+        # Sort once and treat every group on the shared arrays;
+        # without group_by the whole frame is a single group in its original order
+        rows = None if quality_index is None else rows_needing(df, quality_index, 'needs_outlier_treatment', group_by)
+        grouped = GroupedFrame(df, columns, group_by=group_by, month_variable=month_variable, mmap_dir=self.mmap_dir, rows=rows)
+        try:
+            outliers = self._detect_and_treat(grouped.values, grouped.offsets, method, **kwargs)
+            grouped.write_back(df)
+        finally:
+            grouped.close()
+
+        mask = np.zeros((len(df), len(columns)), dtype=bool)
+        mask[grouped.positions] = outliers.T
+        return df, pd.DataFrame(mask, index=df.index, columns=columns)
+
+    def handle_outliers(self, df, columns, group_by=None, method=None, month_variable=None, quality_index=None, **kwargs):
+        df, _ = self.detect_and_treat(df, columns, group_by=group_by, method=method, month_variable=month_variable,
+                                      quality_index=quality_index, **kwargs)
+        return df
+
+    def _store_statistics(self, method, columns, group_keys, lower, upper, replacement):
+        """Record fitted per-group statistics; also used by DataQualityScanner.scan."""
+        self.fitted_method_ = method
+        self.columns_ = list(columns)
+        self.group_keys_ = group_keys
+        self.lower_, self.upper_, self.replacement_ = lower, upper, replacement
+
+    def fit(self, df, columns, group_by=None, method=None, month_variable=None, quality_index=None, scan_handler=None):
+        """
+        Compute per-group outlier bounds and replacement values without treating the data.
+
+        Rows outside [lower, upper] of their group are outliers and take the group's
+        replacement value, which reproduces handle_outliers for the fitted data.
+        The 'rolling' method depends on neighbouring rows and cannot be fitted.
+
+        With a quality index and the handler it was scanned with (`scan_handler`), only
+        groups flagged `needs_outlier_treatment` are fitted on `df`. The other groups have
+        no nulls, so imputation left them unchanged and their scanned statistics are reused.
+        """
+        if method is None:
+            method = self.method
+
+        reuse_scan = (quality_index is not None and scan_handler is not None
+                      and getattr(scan_handler, 'fitted_method_', None) == method
+                      and scan_handler.columns_ == list(columns))
+        rows = rows_needing(df, quality_index, 'needs_outlier_treatment', group_by) if reuse_scan else None
+        grouped = GroupedFrame(df, columns, group_by=group_by, month_variable=month_variable, mmap_dir=self.mmap_dir, rows=rows)
+        try:
+            lower, upper, replacement = self.group_statistics(grouped.values, grouped.offsets, method)
+        finally:
+            grouped.close()
+        group_keys = grouped.keys
+
+        if reuse_scan:
+            # Scanned groups are in quality index order, so the flags select their statistics directly
+            clean = ~quality_index['needs_outlier_treatment'].to_numpy(dtype=bool)
+            group_keys = pd.concat([group_keys, scan_handler.group_keys_[clean]], ignore_index=True)
+            lower, upper, replacement = [np.concatenate([fitted, scanned[:, clean]], axis=1) for fitted, scanned in
+                                         zip((lower, upper, replacement), (scan_handler.lower_, scan_handler.upper_, scan_handler.replacement_))]
+
+        self._store_statistics(method, columns, group_keys, lower, upper, replacement)
+        return self
+
+    def transform(self, df):
+        """Treat outliers with the fitted per-group bounds by group lookup; unknown groups are left unchanged."""
+        df = df.copy()
+        positions = transformer_state.lookup_groups(df, self.group_keys_)
+        unknown_rows = int((positions < 0).sum())
+        if unknown_rows and self.logger is not None:
+            self.logger.warning(f"{unknown_rows} rows belong to groups without fitted outlier bounds and are left unchanged.")
+        for j, col in enumerate(self.columns_):
+            values = df[col].to_numpy(dtype=np.float64, copy=True)
+            outliers = (values < transformer_state.gather(self.lower_[j], positions)) | \
+                       (values > transformer_state.gather(self.upper_[j], positions))
+            values[outliers] = transformer_state.gather(self.replacement_[j], positions)[outliers]
+            df[col] = values
         return df
+
+    def save_state(self, path):
+        """Save the fitted bounds and replacement values to a compact binary artifact."""
+        metadata = {'transformer': 'TimeSeriesOutlierHandler', 'method': self.fitted_method_,
+                    'threshold': self.threshold, 'columns': self.columns_}
+        transformer_state.save_state(path, metadata, self.group_keys_,
+                                     lower=self.lower_, upper=self.upper_, replacement=self.replacement_)
+
+    def load_state(self, paths):
+        """Load fitted bounds from one or more artifacts written by save_state."""
+        metadata, self.group_keys_, arrays = transformer_state.load_state(paths)
+        self.fitted_method_, self.threshold, self.columns_ = metadata['method'], metadata['threshold'], metadata['columns']
+        self.lower_, self.upper_, self.replacement_ = arrays['lower'], arrays['upper'], arrays['replacement']
+        return self
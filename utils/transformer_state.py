@@ -0,0 +1,68 @@
+#Transformer state: compact binary artifacts of fitted per-group parameters
+import json
+
+import numpy as np
+import pandas as pd
+
+# A state artifact is a compressed .npz file. Per-group parameter arrays keep the
+# group axis last, and a JSON metadata record (stored as bytes) holds the method,
+# column names and group keys. Group keys are stored in metadata rather than as
+# object arrays so the file loads without pickle; their dtypes are stored alongside
+# so keys JSON has no type for (e.g. datetimes) are cast back and still match on load.
+
+_METADATA_KEY = "__metadata__"
+
+
+def save_state(path, metadata, group_keys, **arrays):
+    """Write fitted parameters to `path` (numpy appends '.npz' when missing)."""
+    metadata = dict(metadata, group_keys={col: group_keys[col].tolist() for col in group_keys.columns},
+                    group_key_dtypes={col: str(group_keys[col].dtype) for col in group_keys.columns})
+    encoded = np.frombuffer(json.dumps(metadata, default=str).encode("utf-8"), dtype=np.uint8)
+    np.savez_compressed(path, **{_METADATA_KEY: encoded}, **arrays)
+
+
+def load_state(paths):
+    """
+    Load one or more state artifacts written by `save_state`.
+
+    Several paths (e.g. one per out-of-core chunk, whose groups are disjoint) are
+    combined by concatenating their groups. Returns (metadata, group_keys, arrays).
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    metadata, key_frames, array_parts = None, [], {}
+    for path in paths:
+        with np.load(path, allow_pickle=False) as data:
+            part_metadata = json.loads(data[_METADATA_KEY].tobytes().decode("utf-8"))
+            for name in data.files:
+                if name != _METADATA_KEY:
+                    array_parts.setdefault(name, []).append(data[name])
+        keys = pd.DataFrame(part_metadata.pop("group_keys"))
+        for col, dtype in part_metadata.pop("group_key_dtypes", {}).items():
+            keys[col] = keys[col].astype(dtype)
+        key_frames.append(keys)
+        metadata = metadata or part_metadata
+    arrays = {name: np.concatenate(parts, axis=-1) for name, parts in array_parts.items()}
+    return metadata, pd.concat(key_frames, ignore_index=True), arrays
+
+
+def lookup_groups(df, group_keys):
+    """
+    Position of each row's group in `group_keys` (-1 for groups not seen at fit time).
+
+    Without key columns every row belongs to the single fitted group 0.
+    """
+    if len(group_keys.columns) == 0:
+        return np.zeros(len(df), dtype=np.int64)
+    fitted = pd.MultiIndex.from_frame(group_keys)
+    rows = pd.MultiIndex.from_frame(df[list(group_keys.columns)])
+    return fitted.get_indexer(rows)
+
+
+def gather(params, positions):
+    """Per-row parameters for `positions`, NaN where the group is unknown."""
+    if params.shape[-1] == 0:
+        # Nothing was fitted (e.g. an empty chunk), so every group is unknown
+        return np.full(params.shape[:-1] + np.shape(positions), np.nan)
+    gathered = np.take(params, np.maximum(positions, 0), axis=-1)
+    return np.where(positions >= 0, gathered, np.nan)
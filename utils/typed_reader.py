@@ -0,0 +1,118 @@
+#Typed reader: load CSV/Parquet input with dtypes from column_types applied by the parser
+import os
+
+import pandas as pd
+from pandas.api import types
+
+try:
+    import pyarrow  # noqa: F401  (enables the multithreaded CSV engine and Parquet reads)
+    _PYARROW_AVAILABLE = True
+except ModuleNotFoundError:
+    _PYARROW_AVAILABLE = False
+
+# column_types values -> parser dtypes; 'datetime' columns go through parse_dates instead
+_PARSER_DTYPES = {'float': 'float64', 'int': 'int64', 'str': str, 'bool': 'boolean'}
+
+_DTYPE_CHECKS = {
+    'float': types.is_float_dtype,
+    'int': types.is_integer_dtype,
+    'str': lambda dtype: types.is_string_dtype(dtype) or types.is_object_dtype(dtype),
+    'bool': types.is_bool_dtype,
+    'datetime': types.is_datetime64_any_dtype,
+}
+
+
+def dtypes_match(df, column_types):
+    """True when every column in `column_types` is present with a dtype of the requested kind."""
+    return all(column in df.columns and dtype in _DTYPE_CHECKS and _DTYPE_CHECKS[dtype](df[column].dtype)
+               for column, dtype in column_types.items())
+
+
+class TypedReader:
+    """
+    Read input files in one pass with the `column_types` dtypes, the `required_columns`
+    selection and month parsing handled by the parser, instead of inferring object
+    columns and converting every cell afterwards.
+
+    CSV files use the multithreaded pyarrow engine when pyarrow is installed and the C
+    engine otherwise; Parquet files are read column-pruned and cast. Selecting columns
+    by name also drops any 'Unnamed:' index column written with the file.
+    """
+
+    def __init__(self, project_id, logger, engine=None):
+        self.project_id = project_id
+        self.logger = logger
+        self.engine = engine or ('pyarrow' if _PYARROW_AVAILABLE else 'c')
+
+    def read_kwargs(self, column_types, required_columns=None, month_variable=None, available_columns=None, engine=None):
+        """
+        Keyword arguments for `pd.read_csv` applying the schema.
+
+        Parameters:
+        -----------
+        column_types : dict
+            Column name -> 'float', 'int', 'str', 'bool' or 'datetime'.
+        required_columns : list, optional
+            Columns to load; all columns are loaded when not given.
+        month_variable : str, optional
+            Month column, parsed as dates in addition to the 'datetime' columns.
+        available_columns : list, optional
+            Columns present in the file (e.g. from a header or manifest); requested
+            columns missing from it are left out so the parser does not fail on them.
+        engine : str, optional
+            Parser engine; defaults to the reader's engine. None leaves it unset.
+        """
+        usecols = list(required_columns) if required_columns else None
+        if usecols is not None and available_columns is not None:
+            missing = [col for col in usecols if col not in available_columns]
+            if missing:
+                self.logger.warning(f"Required columns not found in the input: {missing}")
+            usecols = [col for col in usecols if col in available_columns]
+        loaded = set(usecols if usecols is not None else (available_columns or column_types))
+
+        date_columns = [col for col, dtype in column_types.items() if dtype == 'datetime' and col in loaded]
+        if month_variable is not None and month_variable in loaded and month_variable not in date_columns:
+            date_columns.append(month_variable)
+        dtype = {col: _PARSER_DTYPES[kind] for col, kind in column_types.items()
+                 if kind in _PARSER_DTYPES and col in loaded and col not in date_columns}
+
+        kwargs = {'dtype': dtype, 'parse_dates': date_columns}
+        if usecols is not None:
+            kwargs['usecols'] = usecols
+        if engine or self.engine:
+            kwargs['engine'] = engine or self.engine
+        return kwargs
+
+    def _read_parquet(self, source, column_types, required_columns, month_variable):
+        df = pd.read_parquet(source, columns=list(required_columns) if required_columns else None)
+        kwargs = self.read_kwargs(column_types, month_variable=month_variable, available_columns=list(df.columns), engine=None)
+        try:
+            typed = df.astype(kwargs['dtype'])
+            for col in kwargs['parse_dates']:
+                if not types.is_datetime64_any_dtype(typed[col].dtype):
+                    typed[col] = pd.to_datetime(typed[col])
+        except (ValueError, TypeError) as e:
+            self.logger.warning(f"Typed read of {source} failed ({e}); keeping the stored Parquet dtypes.")
+            return df
+        return typed
+
+    def read(self, source, column_types, required_columns=None, month_variable=None, file_format=None):
+        """
+        Read `source` (a local path or a 'gs://' URL) with the schema applied.
+
+        The format is taken from the file extension unless `file_format` ('csv' or
+        'parquet') is given. If the data does not fit the requested dtypes, CSV files are
+        read again without them and Parquet files keep their stored dtypes, leaving the
+        conversion to DataTypeConverter.
+        """
+        file_format = file_format or ('parquet' if os.path.splitext(source)[1].lower() in ('.parquet', '.pq') else 'csv')
+        if file_format == 'parquet':
+            return self._read_parquet(source, column_types, required_columns, month_variable)
+
+        header = pd.read_csv(source, nrows=0).columns
+        kwargs = self.read_kwargs(column_types, required_columns, month_variable, available_columns=list(header))
+        try:
+            return pd.read_csv(source, **kwargs)
+        except (ValueError, TypeError) as e:
+            self.logger.warning(f"Typed read of {source} failed ({e}); reading without dtype hints.")
+            return pd.read_csv(source, usecols=kwargs.get('usecols'), engine=kwargs.get('engine'))